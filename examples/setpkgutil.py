@@ -1,6 +1,7 @@
 import setpkg as _setpkg
 import os
-import platform as _platform
+# memoized functions of the platform module
+_platform = _setpkg.platform_facts
 
 DEV_VERSION_SUFFIX = '.dev'
 
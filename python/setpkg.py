@@ -89,6 +89,13 @@ Used to set global options
         the version used when no version is specified. the os suffix is optional, and should be
         all lower case. e.g. default-version-darwin, default-version-linux.
 
+    replay :
+        whether setpkg may replay the recorded actions of a previous execution of the
+        package instead of executing it again (default false). only set it to true if
+        the package reads no inputs other than ``env`` and the functions provided to it:
+        reads of ``os.environ``, files on disk or modules such as setpkgutil are not
+        tracked.
+
 example main section::
 
     [main]
@@ -107,6 +114,14 @@ dependencies) will be reloaded with the new version.  If no version is specified
 and the package is already loaded, it will be used as is, otherwise the default
 version will be loaded.
 
+When a package is switched to another version or reloaded, the packages which require
+it are reloaded too, unless setpkg recorded, when they were last executed, that they
+neither read nor modified any of the variables which the package sets (reads include
+``$VAR`` references in the values they set), and that the setpkg functions they called
+still give the same results. This is recorded whenever a package is executed, whether
+or not it enables ``replay``, and also when ``SETPKG_NO_REPLAY`` is set; reads which do
+not go through ``env`` or the setpkg functions, such as ``os.environ``, are not seen.
+
 The left side of each requires statement is a unix-style glob pattern for specifying
 which versions of the current package to associate with the requirement on the
 right side::
@@ -180,8 +195,10 @@ is executed.
         can also be configured to log to a file.
 
     platform module :
-        the contents of the builtin ``platform`` module
-        (equivalent of ``from platform import *``)
+        the functions of the builtin ``platform`` module (equivalent of
+        ``from platform import *``). they are memoized: each is only called once
+        per host, with the same arguments. for a fresh value, call the
+        function's ``uncached`` attribute, ie ``architecture.uncached()``
 
     setpkgutil module :
         contents of ``setpkgutil`` module, if it exists. this module can be used
@@ -265,6 +282,41 @@ here's a simple example, using the Nuke package file outlined above::
     $ pkg unset nuke
     removing:   [-]  nuke-6.0v6
 
+``pkg set`` can set several packages together, in order. This is faster than setting
+them one at a time, and requirements which they share are only set once. Because the
+words after a package are arguments for that package, the list of packages must end
+with ``--``; any arguments after the ``--`` go to the last package::
+
+    $ pkg set nuke maya houdini --
+
+To see what ``pkg set`` would do, without changing anything, use ``--dry-run``. It lists
+the packages which would be added, switched, reloaded or removed, whether each package
+would be executed or replayed (see ``SETPKG_NO_REPLAY``), and how long that took the
+last time::
+
+    $ pkg set --dry-run nuke-6.0v6
+    switching:  [+]  nuke-6.1v2 --> 6.0v6              run          31.2 ms
+    plan: 1 switching; 1 run, 0 replayed; estimated 31.2 ms
+
+``pkg unset --all`` removes every active package and ends the session. The session keeps
+the values which the variables had before the first package was set, so they are
+restored in one step instead of removing each package in turn. If a variable has been
+changed by something other than ``pkg`` since, the packages are removed one at a time::
+
+    $ pkg unset --all
+
+To switch to other packages for a while, ``pkg push`` saves the active packages and the
+variables they set, and ``pkg pop`` later restores them in one step, without executing
+any package. Checkpoints can be nested::
+
+    $ pkg push
+    pushing:    [+]  checkpoint 1
+    $ pkg set nuke-6.1v2
+    $ pkg pop
+    removing:   [-]  nuke-6.1v2
+    restoring:  [+]  nuke-6.0v6
+    popping:    [-]  checkpoint 1
+
 There are also several handy aliases available:
 
 ========  ===========
@@ -325,6 +377,75 @@ Optional Environment Variables
         $ pkg set nuke
         adding:     [+]  nuke-6.1v2
 
+``SETPKG_CACHE_DIR``
+    Directory in which setpkg keeps caches that persist between invocations, such
+    as parsed ``.pykg`` headers and compiled package bodies. Entries are keyed on
+    the size, modification time and inode of the file they were read from, so
+    editing a ``.pykg`` invalidates them automatically. Defaults to ``$XDG_CACHE_HOME/setpkg``, or ``~/.cache/setpkg``.
+
+    The shell startup scripts also source the system aliases generated for the
+    current ``SETPKG_PATH`` from ``aliases/`` in this directory, instead of
+    reading every ``.pykg``, and regenerate them in the background. Run
+    ``pkg system-alias`` to pick up a changed package's aliases immediately.
+
+``SETPKG_NO_CACHE``
+    If set to a non-empty value, caches are kept in memory only and are never
+    read from or written to ``SETPKG_CACHE_DIR``.
+
+``SETPKG_NO_REPLAY``
+    When a ``.pykg`` which enables the ``replay`` option of its main section is executed,
+    setpkg records the changes it makes to the environment and the variables and functions
+    it reads, and the next time the same version of the unchanged file is set, it replays
+    those changes if everything it read is the same. If set, packages are always executed.
+
+``SETPKG_RESOLVE_CACHE_SIZE``
+    ``pkg run`` and ``runpkg`` remember the environment produced by setting a package,
+    and reuse it when the same package is run again from the same environment, as long
+    as none of the ``.pykg`` files involved have changed. Variables which the shell
+    changes as you work, such as ``PWD`` and ``SHLVL``, are ignored unless a package
+    reads or changes them. This is the maximum number of
+    environments kept; the least recently used are discarded first. Defaults to 200,
+    and 0 disables the cache. Only packages which enable the ``replay`` option are
+    cached. ``pkg cache`` shows how often it is used, and ``pkg cache --clear`` empties it.
+
+``SETPKG_JOURNAL_CACHE_SIZE``
+    The maximum number of package journals kept for replay (see ``SETPKG_NO_REPLAY``);
+    the least recently replayed are discarded first. Defaults to 200, and 0 disables replay.
+
+``SETPKG_HASH_MODE``
+    setpkg records a hash of each active ``.pykg`` so that it knows to refresh
+    a package when its file is edited. Hashes are cached by file fingerprint, so a
+    file is only re-read after it changes. Set this to ``stat`` to skip reading
+    files altogether and hash the fingerprint itself; this is intended for read-only
+    production repositories. Changing the mode causes active packages to be
+    refreshed once.
+
+``SETPKG_SESSION_CODEC``
+    How the session data carried in ``SETPKG_SESSION_PKG_*`` is encoded as text.
+    ``b64`` (the default) is a url-safe base64 encoding, a third smaller than ``hex``,
+    the original encoding. Sessions written by either codec can always be read.
+
+``SETPKG_SESSION_COMPRESSION``
+    zlib compression level (0-9) used for the session data. Defaults to 9.
+
+``SETPKG_DAEMON``
+    If set, the shell startup scripts start the resolver daemon (``pkg daemon start --quiet``),
+    a per-user process which keeps setpkg loaded and its caches warm, so that ``pkg``
+    commands, tab completion and startup scripts don't pay to start from scratch.
+    Commands fall back to running in-process whenever the daemon is not running.
+    See ``python/setpkgd.py``.
+
+``SETPKG_DAEMON_SOCKET``
+    Path of the daemon's unix socket. Defaults to ``$TMPDIR/setpkg-<uid>/daemon.sock``.
+
+``SETPKG_NO_DAEMON``
+    If set, ``pkg`` commands never use the daemon.
+
+``SETPKG_DAEMON_TIMEOUT``
+    The number of seconds a ``pkg`` command waits for the daemon to accept it before
+    running in-process instead. Once the daemon has accepted a command, it is left to
+    finish there, however long it takes. Defaults to 10.
+
 
 ----------------------------------
 OSX/Linux
@@ -362,21 +483,20 @@ import os
 import posixpath
 import ntpath
 import sys
-import pprint
 import re
-import subprocess
-import platform
 import cPickle as pickle
-import shelve
-import tempfile
-import shutil
-import hashlib
-import inspect
 import fnmatch
 import binascii
+import base64
 import zlib
-from collections import defaultdict
-from ConfigParser import RawConfigParser, ConfigParser, NoSectionError
+import marshal
+import imp
+import types
+import atexit
+import UserDict
+# to keep startup fast, modules which are only needed by some commands
+# (subprocess, platform, shelve, tempfile, hashlib, inspect, ConfigParser...)
+# are imported where they are used
 
 try:
     from io import BytesIO as StringIO
@@ -392,6 +512,10 @@ REQ_PREFIX = 'SETPKG_REQUIRES_'
 META_SEP = ','
 PKG_SEP = '-'
 LOG_LVL_VAR = 'SETPKG_LOG_LEVEL'
+CACHE_DIR_VAR = 'SETPKG_CACHE_DIR'
+NO_CACHE_VAR = 'SETPKG_NO_CACHE'
+HASH_MODE_VAR = 'SETPKG_HASH_MODE'
+NO_REPLAY_VAR = 'SETPKG_NO_REPLAY'
 
 import logging
 logger = logging.getLogger("setpkg")
@@ -405,10 +529,14 @@ logger.setLevel(logging.DEBUG)
 #logger.addHandler(fh)
 
 sh = logging.StreamHandler()
-if LOG_LVL_VAR in os.environ:
-    sh.setLevel(getattr(logging, os.environ[LOG_LVL_VAR]))
-else:
-    sh.setLevel(logging.WARN)
+def _set_log_level(environ=None):
+    if environ is None:
+        environ = os.environ
+    if LOG_LVL_VAR in environ:
+        sh.setLevel(getattr(logging, environ[LOG_LVL_VAR]))
+    else:
+        sh.setLevel(logging.WARN)
+_set_log_level()
 sformatter = logging.Formatter("%(message)s")
 sh.setFormatter(sformatter)
 logger.addHandler(sh)
@@ -488,6 +616,7 @@ class propertycache(object):
         return result
 
 def _hashfile(filename):
+    import hashlib
     hasher = hashlib.sha1()
     infile = open(filename, 'rb')
     try:
@@ -539,6 +668,7 @@ def executableOutput(exeAndArgs, convertNewlines=True, stripTrailingNewline=True
     Finally, since maya's python build doesn't support universal_newlines, this is always set to False -
     however, set convertNewlines to True for an equivalent result.'''
 
+    import subprocess
     kwargs.setdefault('stdout', subprocess.PIPE)
     kwargs.setdefault('stderr', subprocess.STDOUT)
 
@@ -557,6 +687,600 @@ def executableOutput(exeAndArgs, convertNewlines=True, stripTrailingNewline=True
         return cmdOutput, cmdProcess.returncode
     return cmdOutput
 
+#===============================================================================
+# Caches
+#===============================================================================
+
+def _cache_dir():
+    '''
+    return the per-user directory used to persist caches between invocations
+    '''
+    path = os.environ.get(CACHE_DIR_VAR)
+    if not path:
+        base = os.environ.get('XDG_CACHE_HOME')
+        if not base:
+            base = os.path.join(os.path.expanduser('~'), '.cache')
+        path = os.path.join(base, 'setpkg')
+    return path
+
+def _write_atomic(filename, data):
+    '''
+    write data to filename via a temp file and a rename, so that concurrent
+    readers never see a partially written file
+    '''
+    import tempfile
+    dirname = os.path.dirname(filename)
+    if not os.path.isdir(dirname):
+        os.makedirs(dirname)
+    fd, tmpname = tempfile.mkstemp(prefix=os.path.basename(filename), dir=dirname)
+    f = os.fdopen(fd, 'wb')
+    try:
+        f.write(data)
+    finally:
+        f.close()
+    if os.name == 'nt' and os.path.exists(filename):
+        os.remove(filename)
+    os.rename(tmpname, filename)
+
+def _stat_fingerprint(filename):
+    '''
+    return a (size, mtime, inode) tuple identifying the current state of a file
+    or directory, or None if it does not exist
+    '''
+    try:
+        st = os.stat(filename)
+    except OSError:
+        return None
+    return (st.st_size, st.st_mtime, st.st_ino)
+
+class PersistentCache(object):
+    '''A dictionary which is saved as a pickle in the per-user cache directory
+
+    The data is loaded the first time it is accessed, and is written back when
+    the process exits if it was modified. Entries are stored along with a
+    fingerprint of the file they were derived from, and are discarded on lookup
+    if the file has since changed.
+
+    If ``SETPKG_NO_CACHE`` is set, the cache still works in memory for the
+    life of the process, but is neither read from nor written to disk.
+    '''
+    PICKLE_DATA_VER = 2
+    _instances = []
+
+    def __init__(self, name):
+        self.name = name
+        self._data = None
+        self._dirty = False
+        self._loaded_fingerprint = None
+        self._instances.append(self)
+
+    @staticmethod
+    def enabled():
+        return not os.environ.get(NO_CACHE_VAR)
+
+    @property
+    def filename(self):
+        return os.path.join(_cache_dir(), self.name + '.cache')
+
+    @property
+    def data(self):
+        if self._data is None:
+            self._data = {}
+            if self.enabled():
+                self._loaded_fingerprint = _stat_fingerprint(self.filename)
+                try:
+                    f = open(self.filename, 'rb')
+                except IOError:
+                    pass
+                else:
+                    try:
+                        try:
+                            self._data = pickle.load(f)
+                        except Exception, e:
+                            logger.debug('discarding unreadable cache %s: %s' % (self.filename, e))
+                    finally:
+                        f.close()
+        return self._data
+
+    def lookup(self, key, fingerprint):
+        '''
+        return the value stored for key, or None if it is missing or was stored
+        with a different fingerprint
+        '''
+        try:
+            stored_fingerprint, value = self.data[key]
+        except KeyError:
+            return None
+        if fingerprint is None or stored_fingerprint != fingerprint:
+            return None
+        return value
+
+    def store(self, key, fingerprint, value):
+        if fingerprint is None:
+            return
+        self.data[key] = (fingerprint, value)
+        self._dirty = True
+
+    def discard(self, key):
+        if self.data.pop(key, None) is not None:
+            self._dirty = True
+
+    def mark_dirty(self):
+        '''
+        signal that a stored value was modified in place
+        '''
+        self._dirty = True
+
+    def clear(self):
+        self._data = {}
+        self._dirty = True
+
+    def flush(self):
+        '''
+        write the cache to disk, if it was modified
+        '''
+        if not self._dirty or not self.enabled():
+            return
+        self._dirty = False
+        try:
+            _write_atomic(self.filename,
+                          pickle.dumps(self._data, self.PICKLE_DATA_VER))
+            self._loaded_fingerprint = _stat_fingerprint(self.filename)
+        except (IOError, OSError), e:
+            logger.debug('could not write cache %s: %s' % (self.filename, e))
+
+    def reload(self):
+        '''
+        discard the data loaded by this process if the cache file was since
+        written by another process. for long-lived processes.
+        '''
+        if (self._data is not None and not self._dirty and self.enabled()
+                and _stat_fingerprint(self.filename) != self._loaded_fingerprint):
+            self._data = None
+
+    @classmethod
+    def flush_all(cls):
+        for cache in cls._instances:
+            cache.flush()
+
+    @classmethod
+    def reload_all(cls):
+        for cache in cls._instances:
+            cache.reload()
+
+atexit.register(PersistentCache.flush_all)
+
+# parsed .pykg headers: {pykg file : (fingerprint, header dictionary)}
+header_cache = PersistentCache('headers')
+
+class PackagePathIndex(object):
+    '''Index of the .pykg files in the SETPKG_PATH directories
+
+    The listing of each directory is kept in a persistent cache and is only
+    re-read when the directory's fingerprint (which includes its modification
+    time) changes. Within a process, each directory is only checked once: call
+    `refresh` to re-validate them.
+    '''
+    def __init__(self, cache):
+        self._cache = cache
+        # {directory : sorted list of .pykg files}, validated by this process
+        self._dirs = {}
+        # {tuple of directories : {normcased shortname : .pykg file}}
+        self._packages = {}
+
+    def refresh(self):
+        self._dirs.clear()
+        self._packages.clear()
+
+    def listing(self, directory):
+        '''
+        return a sorted list of the .pykg file names in directory
+        '''
+        try:
+            return self._dirs[directory]
+        except KeyError:
+            pass
+        fingerprint = _stat_fingerprint(directory)
+        files = self._cache.lookup(directory, fingerprint)
+        if files is None:
+            try:
+                files = sorted(f for f in os.listdir(directory) if f.endswith('.pykg'))
+            except OSError:
+                files = []
+            else:
+                self._cache.store(directory, fingerprint, files)
+        self._dirs[directory] = files
+        return files
+
+    def packages(self, directories):
+        '''
+        return a dictionary mapping package short names to .pykg files. when a
+        package exists in more than one directory, the first one wins.
+        '''
+        key = tuple(directories)
+        try:
+            return self._packages[key]
+        except KeyError:
+            pass
+        packages = {}
+        for directory in directories:
+            for f in self.listing(directory):
+                shortname = os.path.normcase(os.path.splitext(f)[0])
+                packages.setdefault(shortname, os.path.join(directory, f))
+        self._packages[key] = packages
+        return packages
+
+    def find(self, directories, name):
+        '''
+        return the .pykg file for the given package short name, or None
+        '''
+        return self.packages(directories).get(os.path.normcase(name))
+
+package_index = PackagePathIndex(PersistentCache('paths'))
+
+# sha1 of .pykg files: {pykg file : (fingerprint, sha1)}
+hash_cache = PersistentCache('hashes')
+
+def _cached_hashfile(filename, stat_only=False):
+    '''
+    return the sha1 of filename, only re-reading the file if its stat
+    fingerprint has changed since it was last hashed.
+
+    if stat_only is True, the file is never read: the hash is computed from the
+    fingerprint alone.  this is intended for read-only repositories, where
+    a content hash adds nothing.
+    '''
+    fingerprint = _stat_fingerprint(filename)
+    if stat_only and fingerprint is not None:
+        import hashlib
+        return hashlib.sha1(repr(fingerprint)).hexdigest()
+    hash = hash_cache.lookup(filename, fingerprint)
+    if hash is None:
+        hash = _hashfile(filename)
+        hash_cache.store(filename, fingerprint, hash)
+    return hash
+
+class CodeCache(object):
+    '''Compiled code of .pykg files
+
+    Code objects are marshalled to a file per .pykg under ``code/`` in the
+    cache directory, along with the fingerprint of the source and the magic
+    number of the interpreter that compiled them, so that a package body is
+    only compiled again when it changes (or by another version of python).
+    '''
+    def __init__(self, name='code'):
+        self.name = name
+        # {pykg file : (fingerprint, code)}
+        self._codes = {}
+
+    def filename(self, source):
+        import hashlib
+        return os.path.join(_cache_dir(), self.name,
+                            hashlib.sha1(os.path.abspath(source)).hexdigest())
+
+    def _read(self, source, fingerprint):
+        try:
+            f = open(self.filename(source), 'rb')
+            try:
+                magic, stored_source, stored_fingerprint, code = marshal.load(f)
+            finally:
+                f.close()
+        except (IOError, OSError, EOFError, ValueError, TypeError):
+            return None
+        if (magic, stored_source, stored_fingerprint) != (imp.get_magic(), source, fingerprint):
+            return None
+        return code
+
+    def _write(self, source, fingerprint, code):
+        try:
+            _write_atomic(self.filename(source),
+                          marshal.dumps((imp.get_magic(), source, fingerprint, code)))
+        except (IOError, OSError, ValueError), e:
+            logger.debug('could not write compiled code of %s: %s' % (source, e))
+
+    def get(self, source):
+        '''
+        return the code object of the .pykg file source
+        '''
+        fingerprint = _stat_fingerprint(source)
+        try:
+            stored_fingerprint, code = self._codes[source]
+            if fingerprint is not None and stored_fingerprint == fingerprint:
+                return code
+        except KeyError:
+            pass
+        code = None
+        if fingerprint is not None and PersistentCache.enabled():
+            code = self._read(source, fingerprint)
+        if code is None:
+            f = open(source, 'rU')
+            try:
+                text = f.read()
+            finally:
+                f.close()
+            code = compile(text, source, 'exec')
+            if fingerprint is not None and PersistentCache.enabled():
+                self._write(source, fingerprint, code)
+        self._codes[source] = (fingerprint, code)
+        return code
+
+code_cache = CodeCache()
+
+class PlatformFacts(object):
+    '''Memoized functions of the `platform` module
+
+    Functions such as ``system()`` are cheap, but others, like
+    ``architecture()``, run external programs.  Each function is called once
+    per process with given arguments, and its result is also kept in a
+    persistent cache, keyed by host and interpreter and validated by
+    ``os.uname()``, so most processes never call it at all.
+
+    For a fresh value, call the function's ``uncached`` attribute (ie,
+    ``platform_facts.system.uncached()``), or call `refresh`.
+    '''
+    # functions whose result may change from call to call
+    VOLATILE = ('popen',)
+
+    def __init__(self, cache):
+        self._cache = cache
+        self._memo = {}
+        self._functions = None
+
+    def functions(self):
+        '''
+        return a dictionary of the memoized public functions of `platform`
+        '''
+        if self._functions is None:
+            import platform
+            import types
+            self._functions = dict((k, self._memoize(k, v))
+                                   for k, v in platform.__dict__.iteritems()
+                                   if not k.startswith('_') and isinstance(v, types.FunctionType))
+        return self._functions
+
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+        try:
+            return self.functions()[name]
+        except KeyError:
+            raise AttributeError(name)
+
+    def refresh(self):
+        '''
+        forget all memoized values, in this process and on disk
+        '''
+        self._memo.clear()
+        self._cache.clear()
+
+    def _host(self):
+        if hasattr(os, 'uname'):
+            return os.uname()
+        return None
+
+    def _memoize(self, name, func):
+        if name in self.VOLATILE:
+            return func
+        def memoized(*args, **kwargs):
+            key = (name, args, tuple(sorted(kwargs.items())))
+            try:
+                return self._memo[key]
+            except KeyError:
+                pass
+            except TypeError:
+                # unhashable arguments
+                return func(*args, **kwargs)
+            host = self._host()
+            cache_key = (host and host[1], sys.executable) + key
+            value = self._cache.lookup(cache_key, host)
+            if value is None:
+                value = func(*args, **kwargs)
+                self._cache.store(cache_key, host, value)
+            self._memo[key] = value
+            return value
+        memoized.__name__ = name
+        memoized.__doc__ = func.__doc__
+        memoized.uncached = func
+        return memoized
+
+# {(host name, python executable, function, args, kwargs) : (os.uname(), value)}
+platform_facts = PlatformFacts(PersistentCache('platform'))
+
+# duration of the last execution or replay of each package, for the estimates
+# of Plan: {(pykg file, 'run' or 'replay') : (hash, seconds)}
+timing_cache = PersistentCache('timings')
+
+# completion choices of each .pykg file:
+# {(pykg file, aliases, regexp, system) : (fingerprint, [version, ...])}
+completion_cache = PersistentCache('completions')
+
+def _cksum_table():
+    table = []
+    for i in range(256):
+        c = i << 24
+        for j in range(8):
+            if c & 0x80000000:
+                c = ((c << 1) ^ 0x04C11DB7) & 0xffffffff
+            else:
+                c = (c << 1) & 0xffffffff
+        table.append(c)
+    return table
+
+_CKSUM_TABLE = _cksum_table()
+
+def _cksum(data):
+    '''
+    return the POSIX cksum of data as 'CRC-LENGTH', so that shell scripts can
+    compute the same key with `printf %s "$data" | cksum`
+    '''
+    crc = 0
+    for c in data:
+        crc = ((crc << 8) & 0xffffffff) ^ _CKSUM_TABLE[(crc >> 24) ^ ord(c)]
+    length = len(data)
+    while length:
+        crc = ((crc << 8) & 0xffffffff) ^ _CKSUM_TABLE[(crc >> 24) ^ (length & 0xff)]
+        length >>= 8
+    return '%d-%d' % (~crc & 0xffffffff, len(data))
+
+def system_alias_file(shell_name, setpkg_path):
+    '''
+    return the path of the generated system-alias script for the given shell
+    and SETPKG_PATH value.  the startup scripts source this file directly,
+    and compute its path the same way.
+    '''
+    return os.path.join(_cache_dir(), 'aliases',
+                        '%s-%s' % (shell_name, _cksum(setpkg_path)))
+
+# generated system-alias scripts:
+# {(shell name, SETPKG_PATH) : (repository fingerprint, script)}
+alias_cache = PersistentCache('aliases')
+
+class BoundedCache(PersistentCache):
+    '''A PersistentCache which keeps at most a fixed number of entries
+
+    The maximum is read from the environment variable named by ``SIZE_VAR``;
+    when there are more entries, the least recently used are evicted. The time
+    each entry was last used and the counters are kept in a second, smaller
+    cache, so that a hit does not rewrite the stored values.
+    '''
+    SIZE_VAR = None
+    DEFAULT_SIZE = 200
+    COUNTERS = ('evictions',)
+
+    def __init__(self, name):
+        super(BoundedCache, self).__init__(name)
+        # {'used' : {key : time last used}, 'evictions' : int, ...}
+        self.usage = PersistentCache(name + '-usage')
+
+    @property
+    def size(self):
+        try:
+            return int(os.environ.get(self.SIZE_VAR, self.DEFAULT_SIZE))
+        except ValueError:
+            return self.DEFAULT_SIZE
+
+    def _usage(self):
+        data = self.usage.data
+        if 'used' not in data:
+            data['used'] = {}
+            for counter in self.COUNTERS:
+                data[counter] = 0
+        return data
+
+    def _count(self, counter):
+        self._usage()[counter] += 1
+        self.usage.mark_dirty()
+
+    def _touch(self, key):
+        import time
+        self._usage()['used'][key] = time.time()
+        self.usage.mark_dirty()
+
+    def lookup(self, key, fingerprint):
+        value = super(BoundedCache, self).lookup(key, fingerprint)
+        if value is not None:
+            self._touch(key)
+        return value
+
+    def store(self, key, fingerprint, value):
+        '''
+        store value for key, evicting the least recently used entries if the
+        cache is full
+        '''
+        size = self.size
+        if size <= 0 or fingerprint is None:
+            return
+        super(BoundedCache, self).store(key, fingerprint, value)
+        self._touch(key)
+        used = self._usage()['used']
+        excess = len(self.data) - size
+        if excess > 0:
+            for old in sorted(self.data, key=lambda k: used.get(k, 0))[:excess]:
+                self.discard(old)
+                self._count('evictions')
+        for old in set(used).difference(self.data):
+            del used[old]
+
+    def clear(self):
+        super(BoundedCache, self).clear()
+        self.usage.clear()
+
+class ResolutionCache(BoundedCache):
+    '''A BoundedCache of the environment changes made by setting a package
+
+    Used by `resolvepkg`. Entries are keyed on the requested package and the
+    environment it was set in, and hold the resulting (changed, removed)
+    variables. They are fingerprinted with every ``.pykg`` file and package
+    directory consulted while resolving the package, and with setpkgutil.
+
+    At most ``SETPKG_RESOLVE_CACHE_SIZE`` entries are kept. The hit and miss
+    counts are kept alongside the time each entry was last used.
+    '''
+    SIZE_VAR = 'SETPKG_RESOLVE_CACHE_SIZE'
+    COUNTERS = ('hits', 'misses', 'stale', 'evictions')
+
+    @staticmethod
+    def fingerprint(dirs, files):
+        '''
+        return the fingerprint of a resolution which consulted the given
+        package directories and .pykg files
+        '''
+        return (_import_setpkgutil()[1],
+                tuple((d, _stat_fingerprint(d)) for d in dirs),
+                tuple((f, _stat_fingerprint(f)) for f in sorted(files)))
+
+    def get(self, key):
+        '''
+        return the value stored for key, or None if there is none, or if any of
+        the files it was derived from have changed
+        '''
+        try:
+            fingerprint, value = self.data[key]
+        except KeyError:
+            self._count('misses')
+            return None
+        setpkgutil, dirs, files = fingerprint
+        if self.fingerprint([d for d, fp in dirs], [f for f, fp in files]) != fingerprint:
+            self._count('stale')
+            return None
+        self._count('hits')
+        self._touch(key)
+        return value
+
+    def put(self, key, dirs, files, value):
+        '''
+        store value for key, fingerprinted with the given package directories
+        and .pykg files
+        '''
+        self.store(key, self.fingerprint(dirs, files), value)
+
+    def stats(self):
+        '''
+        return a dictionary of the number of entries, the maximum number of
+        entries, and the hit and miss counters
+        '''
+        stats = dict((counter, self._usage()[counter]) for counter in self.COUNTERS)
+        stats['entries'] = len(self.data)
+        stats['size'] = self.size
+        lookups = stats['hits'] + stats['misses'] + stats['stale']
+        stats['hit rate'] = float(stats['hits']) / lookups if lookups else 0.0
+        return stats
+
+# resolved environments, used by resolvepkg:
+# {sha1 of (package, args, environ) : (resolution fingerprint, (changed, removed))}
+resolution_cache = ResolutionCache('resolutions')
+
+class JournalCache(BoundedCache):
+    '''A BoundedCache of the journals recorded when packages are executed
+
+    At most ``SETPKG_JOURNAL_CACHE_SIZE`` journals are kept.
+    '''
+    SIZE_VAR = 'SETPKG_JOURNAL_CACHE_SIZE'
+
+# journals of package executions, replayed by Session._replay_package:
+# {(pykg file, version) : ((hash, setpkgutil fingerprint, host), journal)}
+journal_cache = JournalCache('journals')
+
 #===============================================================================
 # Shell Classes
 #===============================================================================
@@ -643,6 +1367,7 @@ class WinShell(Shell):
             else:
                 volatile_value = value
             # exclamation marks allow delayed expansion
+            import subprocess
             quotedValue = subprocess.list2cmdline([volatile_value])
             cmd = 'setenv -v %s %s\n' % (key, quotedValue)
         else:
@@ -673,7 +1398,20 @@ shells = { 'bash' : Bash,
            'DOS' : WinShell}
 
 def get_shell_name():
-    command = executableOutput(['ps', '-o', 'args=', '-p', str(os.getppid())]).strip()
+    ppid = os.getppid()
+    # where there is a /proc filesystem, read the parent's command line from it
+    # rather than spawning ps
+    try:
+        f = open('/proc/%d/cmdline' % ppid, 'rb')
+        try:
+            args = f.read().split('\0')
+        finally:
+            f.close()
+        if args[0]:
+            return args[0]
+    except (IOError, OSError):
+        pass
+    command = executableOutput(['ps', '-o', 'args=', '-p', str(ppid)]).strip()
     return command.split()[0]
 
 def get_shell_class(shell_name):
@@ -704,7 +1442,7 @@ class EnvironSwapper(object):
         if environ is None:
             environ = dict(os.environ)
         else:
-            environ = dict(environ)
+            environ = environ.copy()
 
         if removeNones:
             noneKeys = [k for k, v in environ.iteritems() if v is None]
@@ -720,6 +1458,257 @@ class EnvironSwapper(object):
     def __exit__(self, *args):
         os.environ = self.oldEnviron
 
+class OverlayEnviron(UserDict.DictMixin):
+    '''An environment layered over another, without copying it
+
+    Reads fall through to the base environment. Changes are recorded in a
+    delta, and are never written to the base, so the cost of the overlay
+    depends on the number of variables changed, not on the size of the base.
+
+    >>> base = {'FOO': 'foo', 'BAR': 'bar'}
+    >>> environ = OverlayEnviron(base)
+    >>> environ['FOO'] = 'new'
+    >>> del environ['BAR']
+    >>> sorted(environ.items())
+    [('FOO', 'new')]
+    >>> environ.changes()
+    ({'FOO': 'new'}, {'BAR': 'bar'})
+    >>> sorted(base.items())
+    [('BAR', 'bar'), ('FOO', 'foo')]
+    '''
+    # marks a variable deleted from the base
+    _deleted = object()
+
+    def __init__(self, base):
+        self.base = base
+        # {name : value}, where value is a string, None, _deleted, or a
+        # PathList which is joined when it is read
+        self._delta = {}
+
+    def __getitem__(self, key):
+        try:
+            value = self._delta[key]
+        except KeyError:
+            return self.base[key]
+        if value is self._deleted:
+            raise KeyError(key)
+        if value.__class__ is PathList:
+            return value.value()
+        return value
+
+    def __setitem__(self, key, value):
+        self._delta[key] = value
+
+    def __delitem__(self, key):
+        if key not in self:
+            raise KeyError(key)
+        self._delta[key] = self._deleted
+
+    def __contains__(self, key):
+        try:
+            value = self._delta[key]
+        except KeyError:
+            return key in self.base
+        return value is not self._deleted
+
+    def get(self, key, default=None):
+        try:
+            value = self._delta[key]
+        except KeyError:
+            return self.base.get(key, default)
+        if value is self._deleted:
+            return default
+        if value.__class__ is PathList:
+            return value.value()
+        return value
+
+    def __iter__(self):
+        delta = self._delta
+        for key in self.base:
+            if key not in delta:
+                yield key
+        for key, value in delta.iteritems():
+            if value is not self._deleted:
+                yield key
+
+    def iteritems(self):
+        delta = self._delta
+        for key, value in self.base.iteritems():
+            if key not in delta:
+                yield key, value
+        for key, value in delta.iteritems():
+            if value is not self._deleted:
+                if value.__class__ is PathList:
+                    value = value.value()
+                yield key, value
+
+    def keys(self):
+        return list(self)
+
+    def __len__(self):
+        length = len(self.base)
+        for key, value in self._delta.iteritems():
+            if key in self.base:
+                if value is self._deleted:
+                    length -= 1
+            elif value is not self._deleted:
+                length += 1
+        return length
+
+    def copy(self):
+        # os.environ is a UserDict: copying its dictionary is much faster
+        environ = dict(getattr(self.base, 'data', self.base))
+        for key, value in self._delta.iteritems():
+            if value is self._deleted:
+                environ.pop(key, None)
+            elif value.__class__ is PathList:
+                environ[key] = value.value()
+            else:
+                environ[key] = value
+        return environ
+
+    def path_list(self, key):
+        '''
+        return the value of variable key as a PathList, which is kept in the
+        overlay, so that changes to it change the variable
+        '''
+        value = self._delta.get(key)
+        if value.__class__ is PathList:
+            return value
+        paths = PathList(self[key])
+        self._delta[key] = paths
+        return paths
+
+    def changes(self):
+        '''
+        return dictionaries of the variables which differ from the base: those
+        changed, with their new values, and those removed, with their values in
+        the base. a variable set to None counts as removed
+        '''
+        base = self.base
+        changed = {}
+        removed = {}
+        for key, value in self._delta.iteritems():
+            if value is self._deleted or value is None:
+                if key in base:
+                    removed[key] = base[key]
+                continue
+            if value.__class__ is PathList:
+                value = value.value()
+            if base.get(key) != value:
+                changed[key] = value
+        return changed, removed
+
+def _tally(counts, key, n):
+    count = counts.get(key, 0) + n
+    if count:
+        counts[key] = count
+    else:
+        del counts[key]
+
+class PathList(object):
+    '''The parts of a path-like variable, such as PATH
+
+    While a session changes a variable, its parts are kept in a list, with a
+    count of each part, instead of splitting and joining the string for each
+    change. It is only joined again when the variable is read.
+    '''
+    def __init__(self, value):
+        self._parts = _split(value)
+        self._value = value
+        # {part : count}, built on the first lookup
+        self._counts = None
+        # {expanded part : count} of the parts which expand the same in any
+        # environment, and {part : count} of the others, for no_dupes. built
+        # on the first lookup of an expanded value
+        self._static = None
+        self._dynamic = None
+
+    def __len__(self):
+        return len(self._parts)
+
+    def __iter__(self):
+        return iter(self._parts)
+
+    def value(self):
+        if self._value is None:
+            self._value = _join(self._parts)
+        return self._value
+
+    def __contains__(self, part):
+        if self._counts is None:
+            self._counts = {}
+            for p in self._parts:
+                _tally(self._counts, p, 1)
+        return part in self._counts
+
+    def contains_expanded(self, value, environ):
+        '''
+        whether any part expands to value. the same as
+            value in [_expand(x, environ=environ) for x in parts]
+        '''
+        if self._static is None:
+            self._static = {}
+            self._dynamic = {}
+            for part in self._parts:
+                self._tally_expanded(part, 1)
+        if value in self._static:
+            return True
+        for part in self._dynamic:
+            if _expand(part, environ=environ) == value:
+                return True
+        return False
+
+    def _tally_expanded(self, part, n):
+        # _expand only normalizes parts without variables or a leading ~
+        if '$' not in part and not part.startswith('~'):
+            _tally(self._static, os.path.normpath(part), n)
+        else:
+            _tally(self._dynamic, part, n)
+
+    def _count(self, part, n):
+        if self._counts is not None:
+            _tally(self._counts, part, n)
+        if self._static is not None:
+            self._tally_expanded(part, n)
+
+    def insert(self, value, at_end=False):
+        '''
+        add value, which may hold several parts, to the front or the end
+        '''
+        parts = _split(value)
+        if at_end:
+            self._parts.extend(parts)
+        else:
+            self._parts[0:0] = parts
+        for part in parts:
+            self._count(part, 1)
+        self._value = None
+
+    def remove(self, part, from_end=False):
+        '''
+        remove the first or last occurrence of part. returns whether it was
+        found
+        '''
+        if part not in self:
+            return False
+        if from_end:
+            index = len(self._parts) - 1 - self._parts[::-1].index(part)
+        else:
+            index = self._parts.index(part)
+        del self._parts[index]
+        self._count(part, -1)
+        self._value = None
+        return True
+
+    def replace(self, parts):
+        '''
+        replace all the parts
+        '''
+        self._parts = list(parts)
+        self._counts = self._static = self._dynamic = None
+        self._value = None
+
 def _abspath(root, value):
     # not all variables are paths: only absolutize if it looks like a relative path
     if root and \
@@ -728,15 +1717,82 @@ def _abspath(root, value):
         value = os.path.join(root, value)
     return value
 
+# The same as the patterns used by posixpath.expandvars
+_VAR_RE = re.compile(r'\$(\w+|\{[^}]*\})')
+_UVAR_RE = re.compile(ur'\$(\w+|\{[^}]*\})', re.UNICODE)
+
+# {(type, value) : template} of the values expanded so far; see _template.
+# str and unicode values which compare equal are split differently
+_templates = {}
+_MAX_TEMPLATES = 1000
+
+def _template(value):
+    '''
+    split value into a tuple alternating between literal text and the
+    variables it refers to, as (name, text) pairs:
+        (literal, (name, text), literal, ..., literal)
+    '''
+    key = (type(value), value)
+    try:
+        return _templates[key]
+    except KeyError:
+        pass
+    if isinstance(value, unicode):
+        varprog = _UVAR_RE
+        encoding = sys.getfilesystemencoding()
+    else:
+        varprog = _VAR_RE
+        encoding = None
+    template = []
+    start = 0
+    # expandvars resumes searching after each substituted value, so it finds
+    # the same matches as searching the unexpanded value
+    for match in varprog.finditer(value):
+        name = match.group(1)
+        if name.startswith('{') and name.endswith('}'):
+            name = name[1:-1]
+        if encoding:
+            name = name.encode(encoding)
+        template.append(value[start:match.start()])
+        template.append((name, match.group(0)))
+        start = match.end()
+    template.append(value[start:])
+    template = tuple(template)
+    if len(_templates) >= _MAX_TEMPLATES:
+        _templates.clear()
+    _templates[key] = template
+    return template
+
+def _expandvars(value, environ):
+    '''
+    equivalent of posixpath.expandvars, but expands the variables in environ,
+    instead of os.environ. variables which are None are treated as unset
+    '''
+    if '$' not in value:
+        return value
+    template = _template(value)
+    if len(template) == 1:
+        return value
+    encoding = sys.getfilesystemencoding() if isinstance(value, unicode) else None
+    parts = [template[0]]
+    for i in xrange(1, len(template), 2):
+        name, text = template[i]
+        var = environ.get(name)
+        if var is None:
+            parts.append(text)
+        elif encoding:
+            parts.append(var.decode(encoding))
+        else:
+            parts.append(var)
+        parts.append(template[i + 1])
+    return ''.join(parts)
+
 def _expand(value, strip_quotes=False, environ=None):
-    # use posixpath because setpkg expects posix-style paths and variable expansion
-    # (on windows: os.path.expandvars will not expand $FOO-x64)
+    # use posixpath semantics because setpkg expects posix-style paths and variable
+    # expansion (on windows: os.path.expandvars will not expand $FOO-x64)
     if environ is None:
-        expanded = posixpath.expandvars(value)
-    else:
-        with EnvironSwapper(environ):
-            expanded = posixpath.expandvars(value)
-    expanded = os.path.normpath(os.path.expanduser(expanded))
+        environ = os.environ
+    expanded = os.path.normpath(os.path.expanduser(_expandvars(value, environ)))
     if strip_quotes:
         expanded = expanded.strip('"')
     return expanded
@@ -744,6 +1800,24 @@ def _expand(value, strip_quotes=False, environ=None):
 def _split(value):
     return value.split(os.pathsep)
 
+def _find_run(parts, run, from_end=False):
+    '''
+    return the index of the first (or last) occurrence of the list run in the
+    list parts, or None
+    '''
+    if not run:
+        return len(parts) if from_end else 0
+    n = len(run)
+    if from_end:
+        indices = xrange(len(parts) - n, -1, -1)
+    else:
+        indices = xrange(len(parts) - n + 1)
+    first = run[0]
+    for i in indices:
+        if parts[i] == first and parts[i:i + n] == run:
+            return i
+    return None
+
 def _join(values):
     return os.pathsep.join(values)
 
@@ -770,11 +1844,28 @@ def _prep_env_args(value, expand, root, environ):
         environ = os.environ
     return value, environ
 
-def prependenv(name, value, expand=True, no_dupes=False, root=None, environ=None):
+def _insertenv(name, value, at_end=False, expand=True, no_dupes=False, root=None,
+               environ=None):
+    '''
+    add value to the front or the end of the variable name. returns the value
+    added, and whether the variable was changed: it is not, if no_dupes is
+    given and the value is already present
+    '''
     value, environ = _prep_env_args(value, expand, root, environ)
 
+    inserted = True
     if name not in environ:
         environ[name] = value
+    elif isinstance(environ, OverlayEnviron):
+        # change the parts in place, rather than splitting and joining
+        paths = environ.path_list(name)
+        if no_dupes:
+            if expand:
+                inserted = not paths.contains_expanded(value, environ)
+            else:
+                inserted = value not in paths
+        if inserted:
+            paths.insert(value, at_end)
     else:
         current_value = environ[name]
         parts = _split(current_value)
@@ -783,48 +1874,28 @@ def prependenv(name, value, expand=True, no_dupes=False, root=None, environ=None
                 expanded_parts = [_expand(x, environ=environ) for x in parts]
             else:
                 expanded_parts = parts
-            if value not in expanded_parts:
+            inserted = value not in expanded_parts
+        if inserted:
+            if at_end:
+                parts.append(value)
+            else:
                 parts.insert(0, value)
-                new_value = _join(parts)
-                environ[name] = new_value
-        else:
-            parts.insert(0, value)
             new_value = _join(parts)
             environ[name] = new_value
 
     # update_pypath
     if name == 'PYTHONPATH':
-        sys.path.insert(0, value)
-    #print "prepend", name, value
-    return value
+        if at_end:
+            sys.path.append(value)
+        else:
+            sys.path.insert(0, value)
+    return value, inserted
+
+def prependenv(name, value, expand=True, no_dupes=False, root=None, environ=None):
+    return _insertenv(name, value, False, expand, no_dupes, root, environ)[0]
 
 def appendenv(name, value, expand=True, no_dupes=False, root=None, environ=None):
-    value, environ = _prep_env_args(value, expand, root, environ)
-
-    if name not in environ:
-        environ[name] = value
-    else:
-        current_value = environ[name]
-        parts = _split(current_value)
-        if no_dupes:
-            if expand:
-                expanded_parts = [_expand(x, environ=environ) for x in parts]
-            else:
-                expanded_parts = parts
-            if value not in expanded_parts:
-                parts.append(value)
-                new_value = _join(parts)
-                environ[name] = new_value
-        else:
-            parts.append(value)
-            new_value = _join(parts)
-            environ[name] = new_value
-
-    # update_pypath
-    if name == 'PYTHONPATH':
-        sys.path.append(value)
-    #print "append", name, value
-    return value
+    return _insertenv(name, value, True, expand, no_dupes, root, environ)[0]
 
 def prependenvs(name, value, root=None, environ=None):
     '''
@@ -854,6 +1925,18 @@ def unsetenv(name, environ=None):
 def popenv(name, value, expand=True, root=None, environ=None, from_end=False):
     value, environ = _prep_env_args(value, expand, root, environ)
 
+    if isinstance(environ, OverlayEnviron):
+        if name not in environ:
+            return
+        paths = environ.path_list(name)
+        if value not in paths:
+            return
+        if len(paths) == 1:
+            del environ[name]
+        else:
+            paths.remove(value, from_end)
+        return value
+
     try:
         current_value = environ[name]
     except KeyError:
@@ -893,6 +1976,9 @@ class Environment(object):
         # use posixpath internally
         self.__dict__['_root'] = _posixpath(root) if root else root
         self.__dict__['_env_vars'] = {}
+        # list of actions and reads, while the package is being executed; see
+        # Session._exec_package
+        self.__dict__['_journal'] = None
 
     def __getattr__(self, attr):
         # For things like '__class__', for instance
@@ -929,16 +2015,38 @@ class Environment(object):
         self.__env__unset__(attr)
 
     def __env__unset__(self, attr):
-        self.__env__get__(attr).unset()
+        # journaled as a single 'delete', rather than as an 'unset'
+        journal = self.__dict__.get('_journal')
+        self.__dict__['_journal'] = None
+        try:
+            self.__env__get__(attr).unset()
+        finally:
+            self.__dict__['_journal'] = journal
+        self.__env__record__('delete', attr, None, {})
         del self.__dict__['_env_vars'][attr]
 
+    def __env__record__(self, *entry):
+        journal = self.__dict__.get('_journal')
+        if journal is not None:
+            journal.append(entry)
+
+    def __env__read__(self, attr, value):
+        journal = self.__dict__.get('_journal')
+        if journal is not None:
+            entry = ('read', attr, value, None)
+            if not journal or journal[-1] != entry:
+                journal.append(entry)
+
     def __contains__(self, attr):
         varObj = self.__dict__['_env_vars'].get(attr)
         if varObj is not None:
             return varObj.value() is not None
-        return self.__dict__['_package'].environ.get(attr) is not None
+        value = self.__dict__['_package'].environ.get(attr)
+        self.__env__read__(attr, value)
+        return value is not None
 
     def __str__(self):
+        import pprint
         return pprint.pformat(self.environ)
 
     def __getstate__(self):
@@ -947,7 +2055,9 @@ class Environment(object):
         for name, var in vars.items():
             if not var._actions:
                 vars.pop(name)
-        return self.__dict__
+        state = self.__dict__.copy()
+        state.pop('_journal', None)
+        return state
 
 
 class EnvironmentVariable(object):
@@ -983,25 +2093,100 @@ class EnvironmentVariable(object):
     def environ(self):
         return self._environ_obj.__dict__['_package'].environ
 
+    def _record(self, method, value, kwargs):
+        '''
+        add an action to the journal of the environment, if it is keeping one.
+        returns the value to give the action.
+        '''
+        env = self._environ_obj
+        if env.__dict__.get('_journal') is None:
+            return value
+        if isinstance(value, EnvironmentVariable):
+            resolved = value.value()
+            if resolved is not None:
+                value = resolved
+        else:
+            resolved = value
+        env.__env__record__(method, self._name, resolved, kwargs.copy())
+        return value
+
     def prepend(self, value, **kwargs):
-        return self._actions.append(Prepend(self._environ_obj, self._name, value,
-                                           **kwargs))
+        value = self._record('prepend', value, kwargs)
+        self._actions.append(Prepend(self._environ_obj, self._name, value,
+                                     **kwargs))
 
     def append(self, value, **kwargs):
-        return self._actions.append(Append(self._environ_obj, self._name, value,
-                                          **kwargs))
+        value = self._record('append', value, kwargs)
+        self._actions.append(Append(self._environ_obj, self._name, value,
+                                    **kwargs))
 
     def set(self, value, **kwargs):
-        return self._actions.append(Set(self._environ_obj, self._name, value,
-                                       **kwargs))
+        value = self._record('set', value, kwargs)
+        self._actions.append(Set(self._environ_obj, self._name, value,
+                                 **kwargs))
 
     def unset(self, **kwargs):
-        return self._actions.append(Set(self._environ_obj, self._name, None,
-                                       **kwargs))
+        self._record('unset', None, kwargs)
+        self._actions.append(Set(self._environ_obj, self._name, None,
+                                 **kwargs))
 
     def pop(self, **kwargs):
-        return self._actions.append(Pop(self._environ_obj, self._name, None,
-                                        **kwargs))
+        self._record('pop', None, kwargs)
+        self._actions.append(Pop(self._environ_obj, self._name, None,
+                                 **kwargs))
+
+    def undo(self):
+        '''
+        undo all the actions on this variable.
+
+        if they were all prepends and appends, the values they added are
+        spliced out of the variable in one step: from the ends, if the
+        variable has not changed since, or else from wherever they are found,
+        still in order. otherwise, each action is undone in reverse order.
+        '''
+        self._environ_obj.__dict__['_package']._session._snapshot(self._name)
+        if not self._splice():
+            for action in reversed(self._actions):
+                action.undo(self._environ_obj, self._name)
+
+    def _splice(self):
+        environ = self.environ
+        if environ.get(self._name) is None:
+            return False
+        front = []
+        back = []
+        for action in self._actions:
+            if isinstance(action, Prepend):
+                if action.inserted:
+                    front.insert(0, action.undo_data)
+            elif isinstance(action, Append):
+                if action.inserted:
+                    back.append(action.undo_data)
+            else:
+                return False
+        if isinstance(environ, OverlayEnviron):
+            paths = environ.path_list(self._name)
+            parts = list(paths)
+        else:
+            paths = None
+            parts = _split(environ[self._name])
+        start = 0
+        end = len(parts) - len(back)
+        if parts[:len(front)] != front:
+            start = _find_run(parts, front)
+        if parts[end:] != back:
+            end = _find_run(parts, back, from_end=True)
+        if start is None or end is None or start + len(front) > end:
+            return False
+        logger.debug("splicing %d values out of %s" % (len(front) + len(back), self._name))
+        parts = parts[:start] + parts[start + len(front):end] + parts[end + len(back):]
+        if not parts:
+            del environ[self._name]
+        elif paths is not None:
+            paths.replace(parts)
+        else:
+            environ[self._name] = _join(parts)
+        return True
 
 
     def setdefault(self, value):
@@ -1039,7 +2224,9 @@ class EnvironmentVariable(object):
         return os.path.join(self.value(), *value.split('/'))
 
     def value(self):
-        return self.environ.get(self._name, None)
+        value = self.environ.get(self._name, None)
+        self._environ_obj.__env__read__(self._name, value)
+        return value
 
     def split(self):
         # FIXME: value could be None.  should we return empty list or raise an error?
@@ -1056,6 +2243,7 @@ class Action(object):
     method
     '''
     def __init__(self, environ_obj, attr, val, undo=True, **kwargs):
+        environ_obj.__dict__['_package']._session._snapshot(attr)
         kwargs['environ'] = environ_obj.__dict__['_package'].environ
         kwargs['root'] = environ_obj.__dict__['_root']
         self.undo_data = self._do_action(attr, val, **kwargs)
@@ -1072,18 +2260,30 @@ class Action(object):
         self._undo_action(attr, self.undo_data, **kwargs)
 
 class Prepend(Action):
+    # False if the value was already present and no_dupes was given, so
+    # nothing was added
+    inserted = True
     def _do_action(self, attr, val, **kwargs):
-        return prependenv(attr, val, **kwargs)
+        val, inserted = _insertenv(attr, val, False, **kwargs)
+        if not inserted:
+            self.inserted = False
+        return val
     def _undo_action(self, attr, val, **kwargs):
         logger.debug("undoing Prepend - %s - %s - %r" % (attr, val, kwargs['environ'].get(attr)))
-        popenv(attr, val, from_end=False, **kwargs)
+        if self.inserted:
+            popenv(attr, val, from_end=False, **kwargs)
 
 class Append(Action):
+    inserted = True
     def _do_action(self, attr, val, **kwargs):
-        return appendenv(attr, val, **kwargs)
+        val, inserted = _insertenv(attr, val, True, **kwargs)
+        if not inserted:
+            self.inserted = False
+        return val
     def _undo_action(self, attr, val, **kwargs):
         logger.debug("undoing Append - %s - %s - %r" % (attr, val, kwargs['environ'].get(attr)))
-        popenv(attr, val, from_end=True, **kwargs)
+        if self.inserted:
+            popenv(attr, val, from_end=True, **kwargs)
 
 class Set(Action):
     def _do_action(self, attr, val, **kwargs):
@@ -1143,6 +2343,13 @@ class PackageExecutionError(PackageError):
     def __str__(self):
         return 'error during execution of %s.pykg file: %s' % (self.package, self.detail)
 
+class CheckpointError(PackageError):
+    def __init__(self, detail):
+        self.package = None
+        self.detail = detail
+    def __str__(self):
+        return 'checkpoint: %s' % self.detail
+
 
 def _shortname(package_name):
     return package_name.split(PKG_SEP, 1)[0]
@@ -1370,6 +2577,11 @@ class Package(RealPackage):
         self._parent = None
         self._dependencies = []
         self._dependents = []
+        # (variables read, session queries made) by the body, if it was
+        # journaled. see Session._uses_vars
+        self._observed = None
+        # variables changed by the body, if it was journaled
+        self._written = None
         super(Package, self).__init__(session=session, root=parent)
 
     def __repr__(self):
@@ -1384,8 +2596,9 @@ class Package(RealPackage):
 
     def _read_packagelist(self, section):
         pkgs = []
-        if self.config.has_section(section):
-            for glob, pkglist in self.config.items(section):
+        items = self.header['sections'].get(section)
+        if items:
+            for glob, pkglist in items:
                 if re.compile(fnmatch.translate(glob)).match(self.version):
                     for pkg in pkglist.split(','):
                         pkgs.append(pkg.strip())
@@ -1431,15 +2644,16 @@ class Package(RealPackage):
         '''
         look up the default version, fist checking environment variables, and then the pykg header
         '''
-        syst = platform.system()
+        syst = platform_facts.system()
         version = self.environ.get('SETPKG_%s_DEFAULT_VERSION_%s' % (self.name.upper(), syst.upper()))
         if not version:
             version = self.environ.get('SETPKG_%s_DEFAULT_VERSION' % self.name.upper())
             if not version:
-                if self.config.has_option('main', 'default-version-%s' % syst.lower()):
-                    version = self.config.get('main', 'default-version-%s' % syst.lower())
-                elif self.config.has_option('main', 'default-version'):
-                    version = self.config.get('main', 'default-version')
+                main = self.header['main']
+                if 'default-version-%s' % syst.lower() in main:
+                    version = main['default-version-%s' % syst.lower()]
+                elif 'default-version' in main:
+                    version = main['default-version']
                 elif len(self.versions) == 1:
                     version = self.versions[0]
                 else:
@@ -1449,19 +2663,45 @@ class Package(RealPackage):
             self._args = args
         return version
 
-    @propertycache
-    def config(self):
-        '''
-        read the header of a package file into a python ConfigParser
-        '''
+    @staticmethod
+    def _new_config():
         # Would like to use defaults of ConfigParser, ie:
         #    config = ConfigParser({'main.versions-from-regex':False})
         # ...but doing so ALSO sets the the default value for main.version to
         # False... probably I just don't understand how to use the defaults...
         # but can't find good docs / examples...
+        from ConfigParser import ConfigParser
         config = ConfigParser()
         # Make option names case-sensitive - for aliases and requires statements
         config.optionxform = str
+        return config
+
+    @propertycache
+    def header(self):
+        '''
+        dictionary of data parsed from the package header:
+
+            text :
+                the raw header text
+            sections :
+                dictionary mapping each section name to a list of (key, value) items
+            main :
+                dictionary of the options in the [main] section
+
+        Headers are kept in the persistent header cache, keyed on the file's
+        fingerprint, so the package file is only read when it has changed.
+        Values derived from the header, such as versions and aliases, are
+        added to the cached dictionary as they are computed
+        (see `_header_value`).
+        '''
+        fingerprint = _stat_fingerprint(self.file)
+        header = header_cache.lookup(self.file, fingerprint)
+        if header is not None:
+            return header
+
+        config = self._new_config()
+        text = ''
+        valid = True
         try:
             lines = _parse_header(self.file)
             text = '\n'.join(lines)
@@ -1469,6 +2709,7 @@ class Package(RealPackage):
     #        if not config.has_section('main'):
     #            raise PackageError(self.name, 'no [main] section in package header')
         except Exception, e:
+            valid = False
             try:
                 selfStr = str(self)
             except Exception:
@@ -1480,6 +2721,47 @@ class Package(RealPackage):
             logger.error('Error reading config for package %s: %s' % (selfStr, exceptionMsg))
             import traceback
             logger.debug(traceback.format_exc())
+        # no need to parse the header twice
+        self.config = config
+
+        sections = dict((section, config.items(section))
+                        for section in config.sections())
+        header = {'text' : text,
+                  'sections' : sections,
+                  'main' : dict(sections.get('main', ()))}
+        # don't cache invalid headers, so that the error is reported each time
+        if valid:
+            header_cache.store(self.file, fingerprint, header)
+        return header
+
+    def _header_value(self, key, func):
+        '''
+        return a value derived from the package header, calling func to compute
+        it if it is not already in the header cache.
+
+        derived values may depend on the operating system (ie, [versions-linux]),
+        so they are stored per-system, for caches shared between hosts.
+        '''
+        key = (key, platform_facts.system())
+        try:
+            return self.header[key]
+        except KeyError:
+            value = func()
+            self.header[key] = value
+            header_cache.mark_dirty()
+            return value
+
+    @propertycache
+    def config(self):
+        '''
+        the header of the package file as a python ConfigParser
+        '''
+        header = self.header
+        # when the header was not cached, reading it already created the config
+        config = self.__dict__.get('config')
+        if config is None:
+            config = self._new_config()
+            config.readfp(StringIO(header['text']))
         return config
 
     @propertycache
@@ -1487,16 +2769,20 @@ class Package(RealPackage):
         '''
         list of versions taken from the `versions` config option in the `main` section
         '''
+        return self._header_value('versions', self._read_versions)
+
+    def _read_versions(self):
         #versions = [v.strip() for v in self.config.get('main', 'versions').split(',')]
+        sections = self.header['sections']
         versions = []
         try:
-            versions = [k.strip() for k, v in self.config.items('versions-' + platform.system().lower())]
-        except NoSectionError:
+            versions = [k.strip() for k, v in sections['versions-' + platform_facts.system().lower()]]
+        except KeyError:
             versions = []
 
         try:
-            versions = [k.strip() for k, v in self.config.items('versions') if k.strip() not in versions]
-        except NoSectionError:
+            versions = [k.strip() for k, v in sections['versions'] if k.strip() not in versions]
+        except KeyError:
             if not self.version_from_regex and not versions:
                 raise PackageError(self.name, 'no [versions] section in package header')
         regexp = self.version_regex
@@ -1519,8 +2805,12 @@ class Package(RealPackage):
         '''
         A dictionary of {alias : version}. Aliases are recursively expanded.
         '''
-        if self.config.has_section('aliases'):
-            aliases = dict([(k, v) for k, v in self.config.items('aliases')])
+        return self._header_value('aliases', self._read_aliases)
+
+    def _read_aliases(self):
+        items = self.header['sections'].get('aliases')
+        if items is not None:
+            aliases = dict([(k, v) for k, v in items])
 
             def expand_alias(alias, value):
                 if value is None:
@@ -1555,9 +2845,13 @@ class Package(RealPackage):
         if no command is provided, this assumes that alias represents a version and it converts
         ('1.0', None) into ('myApp1.0', 'runpkg myApp-1.0')
         '''
+        return self._header_value('system_aliases', self._read_system_aliases)
+
+    def _read_system_aliases(self):
         result = []
-        if self.config.has_section('system-aliases'):
-            for alias, command in self.config.items('system-aliases'):
+        items = self.header['sections'].get('system-aliases')
+        if items:
+            for alias, command in items:
                 # default behavior if no command is provided, is to convert (1.0, None) into (myApp1.0, runpkg myApp-1.0)
                 if not command:
                     command = 'runpkg ' + _joinname(self.name, self.aliases.get(alias, alias))
@@ -1567,17 +2861,38 @@ class Package(RealPackage):
 
     @propertycache
     def version_regex(self):
-        if self.config.has_option('main', 'version-regex'):
-            return re.compile('(?:' + self.config.get('main', 'version-regex') + ')$')
+        main = self.header['main']
+        if 'version-regex' in main:
+            return re.compile('(?:' + main['version-regex'] + ')$')
         return None
 
     @propertycache
     def version_from_regex(self):
-        if (self.version_regex and
-                self.config.has_option('main', 'versions-from-regex')):
-            return self.config.getboolean('main', 'versions-from-regex')
+        main = self.header['main']
+        if self.version_regex and 'versions-from-regex' in main:
+            value = main['versions-from-regex']
+            from ConfigParser import ConfigParser
+            # same rules as ConfigParser.getboolean
+            if value.lower() not in ConfigParser._boolean_states:
+                raise ValueError, 'Not a boolean: %s' % value
+            return ConfigParser._boolean_states[value.lower()]
         return False
 
+    @propertycache
+    def replay(self):
+        '''
+        whether this package may be activated by replaying the journal of a
+        previous execution (see `Session._replay_package`)
+        '''
+        value = self.header['main'].get('replay')
+        if value is None:
+            return False
+        from ConfigParser import ConfigParser
+        # same rules as ConfigParser.getboolean
+        if value.lower() not in ConfigParser._boolean_states:
+            raise ValueError, 'Not a boolean: %s' % value
+        return ConfigParser._boolean_states[value.lower()]
+
     @propertycache
     def version_parts(self):
         '''
@@ -1607,14 +2922,16 @@ class Package(RealPackage):
         read and expand executable-path configuration variable. if it does not exist,
         simply return the short name of the package
         '''
-        if self.config.has_option('main', 'executable-path'):
-            return self.config.get('main', 'executable-path')
+        main = self.header['main']
+        if 'executable-path' in main:
+            return main['executable-path']
         else:
             return self.name
 
     @propertycache
     def hash(self):
-        return _hashfile(self.file)
+        return _cached_hashfile(self.file,
+                                stat_only=self.environ.get(HASH_MODE_VAR) == 'stat')
 
     @property
     def parent(self):
@@ -1697,6 +3014,24 @@ class SessionStorage(object):
     def post_init(self):
         pass
 
+    def flush(self):
+        '''Write out any changes which have not yet been saved
+
+        called once, when the session is finalized
+        '''
+        pass
+
+    def checkpoint(self, exclude=()):
+        '''Return a copy of all the entries, except those with a key in exclude,
+        in a form which can be passed to restore
+        '''
+        raise NotImplementedError
+
+    def restore(self, data, exclude=()):
+        '''Replace all the entries, except those with a key in exclude, with
+        those saved by checkpoint
+        '''
+        raise NotImplementedError
 
     def __getitem__(self, key):
         raise NotImplementedError
@@ -1722,6 +3057,16 @@ class SessionShelf(SessionStorage):
     def __contains__(self, key):
         return key in self.shelf
 
+    def checkpoint(self, exclude=()):
+        return dict((key, self.shelf[key]) for key in self.shelf.keys()
+                    if key not in exclude)
+
+    def restore(self, data, exclude=()):
+        for key in self.shelf.keys():
+            if key not in exclude:
+                del self.shelf[key]
+        self.shelf.update(data)
+
     def pre_init(self):
         self.shelf = self._open_shelf()
 
@@ -1736,6 +3081,8 @@ class SessionShelf(SessionStorage):
     def _open_shelf(self, protocol=None, writeback=False):
         '''
         '''
+        import shelve
+        import tempfile
         pid = self.session.pid
         environ = self.session.environ
         if self.SHELF_FILE_VAR in environ:
@@ -1758,6 +3105,7 @@ class SessionShelf(SessionStorage):
                         full_new_filename = filename + suffix
                         if os.path.isfile(full_new_filename):
                             os.remove(full_new_filename)
+                        import shutil
                         shutil.copy(full_old_filename, full_new_filename)
             # read an existing shelf
             flag = 'w'
@@ -1773,11 +3121,66 @@ class SessionShelf(SessionStorage):
         self.filename = filename
         return shelve.DbfilenameShelf(filename, flag, protocol, writeback)
 
+class SessionCodec(object):
+    '''Converts binary session data to and from text
+
+    The text is stored in environment variables, and must survive being echoed
+    to, and quoted by, every supported shell.
+    '''
+    # recorded with the encoded data, so that it can be decoded by any codec
+    name = None
+
+    def encode(self, binarystr):
+        raise NotImplementedError
+    def decode(self, alphastr):
+        raise NotImplementedError
+
+class HexCodec(SessionCodec):
+    '''Two characters per byte: the original session encoding
+    '''
+    name = 'hex'
+
+    def encode(self, binarystr):
+        return binascii.hexlify(binarystr)
+    def decode(self, alphastr):
+        return binascii.unhexlify(alphastr)
+
+class Base64Codec(SessionCodec):
+    '''Four characters per three bytes, using the url-safe base64 alphabet
+
+    The alphabet is only letters, digits, '-' and '_', which need no escaping
+    in bash, tcsh or DOS. Padding is stripped and restored on decode.
+
+    (there are not 85 characters which are safe in all three shells, so a
+    denser base85 variant is not possible)
+    '''
+    name = 'b64'
+
+    def encode(self, binarystr):
+        return base64.urlsafe_b64encode(binarystr).rstrip('=')
+    def decode(self, alphastr):
+        return base64.urlsafe_b64decode(alphastr + '=' * (-len(alphastr) % 4))
+
+session_codecs = dict((codec.name, codec) for codec in (HexCodec(), Base64Codec()))
+
 class SessionEnv(SessionStorage):
     '''Persistent storage using environment variables
     '''
     SESSION_DATA_PREFIX = 'SETPKG_SESSION_DATA_'
 
+    # Name of the SessionCodec used to write session data, and zlib
+    # compression level (0-9) to use
+    CODEC_VAR = 'SETPKG_SESSION_CODEC'
+    COMPRESSION_VAR = 'SETPKG_SESSION_COMPRESSION'
+    DEFAULT_CODEC = 'b64'
+    DEFAULT_COMPRESSION = 9
+
+    # Data written by a codec is prefixed by the codec name and this separator.
+    # Data without a prefix was written by older versions of setpkg, which
+    # always used hex.
+    CODEC_SEP = '.'
+    LEGACY_CODEC = 'hex'
+
     # Would like to make these per-shell, but that would mean passing down the
     # shell somehow... seems like too much work for a limited benefit
 
@@ -1804,19 +3207,183 @@ class SessionEnv(SessionStorage):
     # available to all python versions that may run setpkg
     PICKLE_DATA_VER = 2
 
+    # Entries are decoded individually, the first time they are accessed, and
+    # changes are only encoded back into the environment when the session is
+    # flushed. Looking up one package therefore only costs decoding that
+    # package, no matter how many are active.
     def __getitem__(self, key):
-        return self.read_dict()[key]
+        try:
+            return self._decoded[key]
+        except KeyError:
+            pass
+        if key in self._dirty:
+            # deleted
+            raise KeyError(key)
+        if self._has_record(key):
+            val = self.read_record(key)
+        else:
+            val = self.legacy_data[key]
+        self._decoded[key] = val
+        return val
     def __setitem__(self, key, val):
-        data = self.read_dict()
-        data[key] = val
-        self.write_dict(data)
+        self._decoded[key] = val
+        self._dirty.add(key)
     def __delitem__(self, key):
-        data = self.read_dict()
-        del data[key]
-        self.write_dict(data)
+        if key not in self:
+            raise KeyError(key)
+        self._decoded.pop(key, None)
+        self._dirty.add(key)
     def __contains__(self, key):
-        return key in self.read_dict()
+        if key in self._decoded:
+            return True
+        if key in self._dirty:
+            return False
+        return self._has_record(key) or key in self.legacy_data
+
+    # A checkpoint is simply the encoded variables, so restoring one needs no
+    # decoding, and leaves the variables exactly as they were.
+    def checkpoint(self, exclude=()):
+        self.flush()
+        environ = self.session.environ
+        return dict((var, environ[var]) for var in self._checkpoint_vars(exclude))
+
+    def restore(self, data, exclude=()):
+        environ = self.session.environ
+        for var in self._checkpoint_vars(exclude):
+            del environ[var]
+        environ.update(data)
+        for key in self._decoded.keys():
+            if key not in exclude:
+                del self._decoded[key]
+        self._dirty.intersection_update(exclude)
+        self._legacy_data = None
+
+    def _checkpoint_vars(self, exclude):
+        return [var for var, val in self.session.environ.iteritems()
+                if val is not None and
+                   ((var.startswith(self.RECORD_PREFIX) and
+                     self._record_key(var) not in exclude) or
+                    var.startswith(self.SESSION_DATA_PREFIX))]
+
+    def keys(self):
+        keys = set(self.record_keys())
+        keys.update(self.legacy_data)
+        keys.update(self._decoded)
+        keys.difference_update(self._dirty.difference(self._decoded))
+        return sorted(keys)
 
+    def pre_init(self):
+        # {key : object} for entries decoded or set by this process
+        self._decoded = {}
+        # keys which have been set or deleted since the last flush
+        self._dirty = set()
+        self._legacy_data = None
+
+    def flush(self):
+        if self._dirty:
+            if self.get_data_vars():
+                # convert a session written in the old single-blob format
+                for key, val in self.legacy_data.iteritems():
+                    if key not in self._dirty:
+                        self.write_record(key, val)
+                self.remove_data_vars()
+            for key in self._dirty:
+                if key in self._decoded:
+                    self.write_record(key, self._decoded[key])
+                else:
+                    self.remove_record(key)
+            self._dirty = set()
+
+    #---------------------------------------------------------------------------
+    # Records
+    #---------------------------------------------------------------------------
+    # Each entry is stored as an independently compressed record, in its own
+    # variables:
+    #     SETPKG_SESSION_PKG_<key>, SETPKG_SESSION_PKG_<key>__1, ...
+    # ...so that changing one package only alters the variables for that
+    # package, and only those need to be sent to the shell.
+    RECORD_PREFIX = 'SETPKG_SESSION_PKG_'
+    RECORD_PART_SEP = '__'
+
+    @property
+    def max_var_size(self):
+        system = platform_facts.system()
+        if system == 'Microsoft':
+            # Bug with platform.system - Vista reports as 'Microsoft'
+            system = 'Windows'
+        return self.MAX_VAR_SIZES[system]
+
+    def record_keys(self):
+        keys = []
+        prefix_len = len(self.RECORD_PREFIX)
+        for var in self.session.environ:
+            if var.startswith(self.RECORD_PREFIX):
+                key = var[prefix_len:]
+                part = key.rpartition(self.RECORD_PART_SEP)[2]
+                if not (self.RECORD_PART_SEP in key and part.isdigit()):
+                    keys.append(key)
+        return keys
+
+    def _record_key(self, var):
+        key = var[len(self.RECORD_PREFIX):]
+        head, sep, part = key.rpartition(self.RECORD_PART_SEP)
+        if sep and part.isdigit():
+            return head
+        return key
+
+    def _has_record(self, key):
+        return self._record_var(key, 0) in self.session.environ
+
+    def _record_var(self, key, part):
+        if part == 0:
+            return self.RECORD_PREFIX + key
+        return self.RECORD_PREFIX + key + self.RECORD_PART_SEP + str(part)
+
+    def read_record(self, key):
+        environ = self.session.environ
+        parts = []
+        i = 0
+        while True:
+            val = environ.get(self._record_var(key, i))
+            if val is None:
+                break
+            parts.append(val)
+            i += 1
+        obj = self.binary_to_python(self.alpha_to_binary(''.join(parts)))
+        # The packages don't pickle their session, so restore it here
+        if isinstance(obj, BasePackage):
+            obj._session = self.session
+        return obj
+
+    def write_record(self, key, val):
+        remainder = self.binary_to_alpha(self.python_to_binary(val))
+        max_size = self.max_var_size
+        i = 0
+        while remainder:
+            var = self._record_var(key, i)
+            getattr(self.setpkg_pkg._environ_obj, var).set(remainder[:max_size],
+                                                           undo=False, expand=False)
+            remainder = remainder[max_size:]
+            i += 1
+        self.remove_record(key, start=i)
+
+    def remove_record(self, key, start=0):
+        i = start
+        while True:
+            var = self._record_var(key, i)
+            if var not in self.session.environ:
+                break
+            else:
+                del self.session.environ[var]
+            i += 1
+
+    #---------------------------------------------------------------------------
+    # Single-blob format
+    #---------------------------------------------------------------------------
+    # Older versions of setpkg stored the whole session as one compressed blob,
+    # split across SETPKG_SESSION_DATA_0, SETPKG_SESSION_DATA_1, ...
+    # These are still read, and are converted to records the next time the
+    # session is written.
     def get_data_vars(self):
         data_vars = [x for x in self.session.environ
                      if x.startswith(self.SESSION_DATA_PREFIX)]
@@ -1833,34 +3400,8 @@ class SessionEnv(SessionStorage):
             vals.append(self.session.environ[var])
         return vals
 
-
-    def read_dict(self):
-        rawstr = ''.join(self.get_data_vars())
-        if not rawstr:
-            return {}
-        package_dict = self.binary_to_python(self.alpha_to_binary(rawstr))
-        # The packages don't pickle their session, so restore it here
-        for obj in package_dict.itervalues():
-            if isinstance(obj, BasePackage):
-                obj._session = self.session
-        return package_dict
-
-    def write_dict(self, newdict):
-        rawstr = self.binary_to_alpha(self.python_to_binary(newdict))
-        remainder = rawstr
+    def remove_data_vars(self):
         i = 0
-        system = platform.system()
-        if system == 'Microsoft':
-            # Bug with platform.system - Vista reports as 'Microsoft'
-            system = 'Windows'
-        max_size = self.MAX_VAR_SIZES[system]
-        while remainder:
-            # We'll start with 1...
-            var = self.SESSION_DATA_PREFIX + str(i)
-            getattr(self.setpkg_pkg._environ_obj, var).set(remainder[:max_size], undo=False)
-            remainder = remainder[max_size:]
-            i += 1
-        # Remove any old env vars > current size
         while True:
             var = self.SESSION_DATA_PREFIX + str(i)
             if var not in self.session.environ:
@@ -1869,20 +3410,65 @@ class SessionEnv(SessionStorage):
                 del self.session.environ[var]
             i += 1
 
+    @property
+    def legacy_data(self):
+        if self._legacy_data is None:
+            rawstr = ''.join(self.get_data_vars())
+            if rawstr:
+                package_dict = self.binary_to_python(self.alpha_to_binary(rawstr))
+                # The packages don't pickle their session, so restore it here
+                for obj in package_dict.itervalues():
+                    if isinstance(obj, BasePackage):
+                        obj._session = self.session
+            else:
+                package_dict = {}
+            self._legacy_data = package_dict
+        return self._legacy_data
+
+    def read_dict(self):
+        '''
+        decode and return all entries
+        '''
+        return dict((key, self[key]) for key in self.keys())
+
     # Even though pickle.loads/dumps give strings which we could theoretically
     # simply stick into environment variables straight up, we will need to
     # eventually echo all set commands out to the shell, and quoting a string
     # with lots of weird characters (even nulls!) would be a nightmare.
     # Therefore, we encode binary strings to strings with just alpha-numeric
-    # characters
+    # characters (see SessionCodec)
+    @propertycache
+    def codec(self):
+        name = self.session.environ.get(self.CODEC_VAR) or self.DEFAULT_CODEC
+        try:
+            return session_codecs[name]
+        except KeyError:
+            logger.warn('unknown session codec %r: using %s' % (name, self.DEFAULT_CODEC))
+            return session_codecs[self.DEFAULT_CODEC]
+
+    @propertycache
+    def compression(self):
+        level = self.session.environ.get(self.COMPRESSION_VAR)
+        if level:
+            try:
+                return max(0, min(9, int(level)))
+            except ValueError:
+                logger.warn('invalid session compression level %r' % (level,))
+        return self.DEFAULT_COMPRESSION
+
     def alpha_to_binary(self, alphastr):
-        return binascii.unhexlify(alphastr)
+        name, sep, data = alphastr.partition(self.CODEC_SEP)
+        if not sep:
+            return session_codecs[self.LEGACY_CODEC].decode(alphastr)
+        return session_codecs[name].decode(data)
 
     def binary_to_alpha(self, binarystr):
-        return binascii.hexlify(binarystr)
+        codec = self.codec
+        return codec.name + self.CODEC_SEP + codec.encode(binarystr)
 
     def python_to_binary(self, py_obj):
-        return zlib.compress(pickle.dumps(py_obj, protocol=self.PICKLE_DATA_VER))
+        return zlib.compress(pickle.dumps(py_obj, protocol=self.PICKLE_DATA_VER),
+                             self.compression)
 
     def binary_to_python(self, bin_obj):
         return pickle.loads(zlib.decompress(bin_obj))
@@ -1917,6 +3503,34 @@ class DefaultSessionMethod(object):
         bound_func.DEFAULT_SESSION_METHOD = self.method
         return bound_func
 
+# {setpkgutil source file : fingerprint when imported}
+_setpkgutil_fingerprints = {}
+
+def _import_setpkgutil():
+    '''
+    import setpkgutil, and return it and the fingerprint of its source, or
+    (None, None) if it does not exist.  if the source has changed since it was
+    imported, the module is reloaded.
+    '''
+    try:
+        import setpkgutil
+    except ImportError:
+        return None, None
+    source = os.path.splitext(setpkgutil.__file__)[0] + '.py'
+    fingerprint = _stat_fingerprint(source)
+    if _setpkgutil_fingerprints.setdefault(source, fingerprint) != fingerprint:
+        setpkgutil = reload(setpkgutil)
+        _setpkgutil_fingerprints[source] = fingerprint
+    return setpkgutil, fingerprint
+
+def _crc(value):
+    '''
+    checksum of the value of a variable, for the session snapshot
+    '''
+    if value is None:
+        return None
+    return zlib.crc32(value)
+
 class Session(object):
     '''
     A persistent session that manages the adding and removing of packages.
@@ -1937,15 +3551,28 @@ class Session(object):
             successfully parsed by `version-regex`; otherwise, None
         - LOGGER: the logger object for this module
         - setpkg: function for setting a sub-package
-        - contents of the builtin `platform` module (equivalent of `from platform import *`)
+        - memoized functions of the builtin `platform` module (equivalent of
+          `from platform import *`; see `PlatformFacts`)
         - contents of `setpkgutil` module, if it exists
     '''
+    # Storage keys of the values the session's variables had before any
+    # package was set, and of checksums of the values the session left them
+    # with; see remove_all. They cannot clash with a package name.
+    BASE_KEY = '__base__'
+    STATE_KEY = '__state__'
+    # Storage key of the checkpoints saved by push
+    STACK_KEY = '__stack__'
+
+    # Variables which only hold setpkg's own data, and which are not part of
+    # the snapshot
+    BOOKKEEPING_RE = re.compile('^SETPKG_(?:(?:VERSION|DEPENDENTS|DEPENDENCIES|SESSION_PKG|SESSION_DATA)_|(?:SESSION|SHELF)$)')
+
     def __new__(cls, pid=None, storage_class=SessionEnv, environ=None):
         if pid is None:
             pid = _getppid()
 
         if environ is None:
-            environ = dict(os.environ)
+            environ = OverlayEnviron(os.environ)
 
         self = super(Session, cls).__new__(cls)
         self._added = []
@@ -1956,6 +3583,16 @@ class Session(object):
         self.storage_class = storage_class
         self._environ_dict = environ
         self.entry_level = 0
+        # (setpkgutil fingerprint, globals shared by all packages)
+        self._globals = None
+        # .pykg files found or listed by this session, for resolvepkg
+        self._package_files = set()
+        # whether no packages were set when the session started, and
+        # {name : value} of the variables changed by the session, as they were
+        # before its first change; see _snapshot
+        self._fresh = None
+        self._initial = {}
+        self._base_changed = False
 
         return self
 
@@ -1980,6 +3617,246 @@ class Session(object):
         self.out.write(('%s:' % action).ljust(12) + prefix + '%s\n' % (package,))
         logger.info('%s: %s' % (package, action))
 
+    # session methods available to packages
+    QUERY_METHODS = ('is_pkg_set', 'current_version', 'current_versions',
+                     'find_package_file', 'walk_package_files',
+                     'list_active_packages', 'list_package_choices',
+                     'list_package_versions', 'current_package_versions')
+
+    # globals set by _exec_package for each package, which setpkgutil may not
+    # override
+    PACKAGE_GLOBALS = ('env', 'VERSION', 'NAME', 'VERSION_PARTS', 'ARGS', 'setpkg')
+
+    def _package_globals(self):
+        '''
+        return the globals shared by all packages executed by this session.
+
+        they are built on first use, and again only if setpkgutil changes.
+        _exec_package copies them and adds the globals specific to each package.
+        '''
+        setpkgutil, fingerprint = _import_setpkgutil()
+        if self._globals is not None and self._globals[0] == fingerprint:
+            return self._globals[1]
+
+        g = {}
+        g['LOGGER'] = logger
+
+        # Considered doing automated detection / adding of all
+        # DefaultSessionMethod funcs to the global namespace...
+        # but then decided it's better to have explicit control...
+#        def isDefaultSessionMethod(x):
+#            meth = getattr(x, 'DEFAULT_SESSION_METHOD', None)
+#            if not meth:
+#                return False
+#            # Don't want hidden methods
+#            return not getattr(x, '__name__', '_').startswith('_')
+#
+#        for name, meth in inspect.getmembers(self, isDefaultSessionMethod):
+#            g[name] = meth
+        for n in self.QUERY_METHODS:
+            g[n] = getattr(self, n)
+
+        # platform utilities, memoized
+        g.update(platform_facts.functions())
+
+        if setpkgutil is not None:
+            protected = set(g).union(self.PACKAGE_GLOBALS)
+            for k, v in setpkgutil.__dict__.iteritems():
+                # filter local
+                if k.startswith('_'):
+                    continue
+                if k in protected:
+                    if g.get(k) is not v:
+                        logger.warn("setpkgutil contains object with protected name %r: ignoring" % k)
+                    continue
+                g[k] = v
+
+        self._globals = (fingerprint, g)
+        return g
+
+    def _journal_key(self, package):
+        '''
+        return the key and fingerprint of the journal of package
+        '''
+        host = None
+        if hasattr(os, 'uname'):
+            host = os.uname()
+        return ((package.file, package.version),
+                (package.hash, _import_setpkgutil()[1], host))
+
+    def _can_replay(self, package):
+        return not self.environ.get(NO_REPLAY_VAR) and package.replay
+
+    @staticmethod
+    def _call_outcome(func, args, kwargs):
+        try:
+            result = func(*args, **kwargs)
+        except Exception, err:
+            return ('error', repr(err)), err
+        if isinstance(result, types.GeneratorType):
+            result = list(result)
+        return ('ok', result), None
+
+    def _run_package(self, package, g):
+        '''
+        execute the body of package, recording a journal of the actions it
+        performs and the inputs it reads. the inputs are kept for `_uses_vars`,
+        and the journal is stored for `_replay_package` if the package may be
+        replayed
+        '''
+        env = g['env']
+
+        def journaled(name, func):
+            def call(*args, **kwargs):
+                outcome, err = self._call_outcome(func, args, kwargs)
+                env.__env__record__('call', name, (args, kwargs), outcome)
+                if err is not None:
+                    raise err
+                return outcome[1]
+            call.__name__ = name
+            call.__doc__ = func.__doc__
+            return call
+        for n in self.QUERY_METHODS:
+            g[n] = journaled(n, g[n])
+
+        journal = []
+        env.__dict__['_journal'] = journal
+        try:
+            exec code_cache.get(package.file) in g
+        finally:
+            env.__dict__['_journal'] = None
+        try:
+            # values given to env may be any python object
+            pickle.dumps(journal, pickle.HIGHEST_PROTOCOL)
+        except (pickle.PicklingError, TypeError), err:
+            logger.debug('%s: cannot store journal: %s' % (package.fullname, err))
+            return
+        package._observed = self._journal_inputs(journal)
+        package._written = self._journal_writes(journal)
+        if self._can_replay(package):
+            key, fingerprint = self._journal_key(package)
+            journal_cache.store(key, fingerprint, journal)
+
+    @staticmethod
+    def _journal_inputs(journal):
+        '''
+        return the names of the variables read by the execution recorded in
+        journal, and the session queries it made, with a checksum of each
+        result
+        '''
+        reads = set()
+        calls = []
+        for kind, name, value, extra in journal:
+            if kind == 'read':
+                reads.add(name)
+            elif kind == 'call':
+                args, kwargs = value
+                calls.append((name, args, kwargs, zlib.crc32(repr(extra))))
+            elif isinstance(value, basestring) and extra.get('expand', True):
+                # the variables expanded in the value of an action are read too
+                if '$' in value:
+                    template = _template(value)
+                    reads.update(ref for ref, text in template[1::2])
+                if value.startswith('~'):
+                    reads.add('HOME')
+        return reads, calls
+
+    @staticmethod
+    def _journal_writes(journal):
+        '''
+        return the names of the variables changed by the execution recorded in
+        journal
+        '''
+        return set(name for kind, name, value, extra in journal
+                   if kind not in ('read', 'call', 'setpkg'))
+
+    def _uses_vars(self, name, names, queries=False):
+        '''
+        return whether the active package name read or modified any of the
+        variables names when it was executed, or made a session query whose
+        result has since changed (or any query, if queries is True).
+
+        returns True if what the package read was not recorded.
+        '''
+        try:
+            package = self.storage[name]
+        except KeyError:
+            return True
+        inputs = getattr(package, '_observed', None)
+        if inputs is None:
+            return True
+        reads, calls = inputs
+        if names.intersection(reads) or names.intersection(package.environ_vars()):
+            return True
+        for method, args, kwargs, crc in calls:
+            if queries:
+                return True
+            outcome = self._call_outcome(getattr(self, method), args, kwargs)[0]
+            if zlib.crc32(repr(outcome)) != crc:
+                return True
+        return False
+
+    def _replay_package(self, package, env, depth=0):
+        '''
+        perform the actions recorded in the journal of a previous execution of
+        package, instead of executing it.
+
+        the journal lists, in order, the actions of the package body, the
+        sub-packages it set, and the environment variables and session methods
+        it read. each read is checked as it is replayed; if any value differs,
+        the actions replayed so far are undone and False is returned, and the
+        package must be executed. also returns False if there is no journal for
+        the package's version, file hash and setpkgutil.
+
+        reads which do not go through ``env`` or the session methods (ie,
+        os.environ, or the file system) are not tracked, so only packages which
+        set ``replay = true`` in their [main] section are replayed.
+        '''
+        if not self._can_replay(package):
+            return False
+        key, fingerprint = self._journal_key(package)
+        journal = journal_cache.lookup(key, fingerprint)
+        if journal is None:
+            return False
+        environ = package.environ
+        env_vars = env.__dict__['_env_vars']
+        saved_vars = env_vars.copy()
+        applied = []
+        for kind, name, value, extra in journal:
+            if kind == 'read':
+                if environ.get(name) != value:
+                    break
+            elif kind == 'call':
+                args, kwargs = value
+                if self._call_outcome(getattr(self, name), args, kwargs)[0] != extra:
+                    break
+            elif kind == 'setpkg':
+                self.add_package(name, parent=package, args=value, depth=depth + 1)
+            elif kind == 'delete':
+                var = env.__env__get__(name)
+                env.__env__unset__(name)
+                applied.append(var)
+            else:
+                var = env.__env__get__(name)
+                if kind in ('unset', 'pop'):
+                    getattr(var, kind)(**extra)
+                else:
+                    getattr(var, kind)(value, **extra)
+                applied.append(var)
+        else:
+            logger.debug('%s: replayed %d journal entries' % (package.fullname, len(journal)))
+            package._observed = self._journal_inputs(journal)
+            package._written = self._journal_writes(journal)
+            return True
+
+        logger.debug('%s: %s %r changed since the journal was recorded' % (package.fullname, kind, name))
+        for var in reversed(applied):
+            var._actions[-1].undo(env, var.name)
+            var._actions.pop()
+        env_vars.clear()
+        env_vars.update(saved_vars)
+        return False
+
     def _exec_package(self, package, depth=0):
         '''
         Excecute the pacakge.
@@ -1988,7 +3865,7 @@ class Session(object):
          - execfile the package file
          - load package dependents
         '''
-        g = {}
+        g = self._package_globals().copy()
         # environment
         g['env'] = package._environ_obj
 
@@ -2000,49 +3877,12 @@ class Session(object):
         g['VERSION_PARTS'] = version_parts
         g['ARGS'] = package.args
 
-        g['LOGGER'] = logger
-
         # setpkg command
         def subpkg(subname, *args):
+            g['env'].__env__record__('setpkg', subname, args, None)
             self.add_package(subname, parent=package, args=args, depth=depth + 1)
         g['setpkg'] = subpkg
 
-        # Considered doing automated detection / adding of all
-        # DefaultSessionMethod funcs to the global namespace...
-        # but then decided it's better to have explicit control...
-#        def isDefaultSessionMethod(x):
-#            meth = getattr(x, 'DEFAULT_SESSION_METHOD', None)
-#            if not meth:
-#                return False
-#            # Don't want hidden methods
-#            return not getattr(x, '__name__', '_').startswith('_')
-#
-#        for name, meth in inspect.getmembers(self, isDefaultSessionMethod):
-#            g[name] = meth
-        for n in ('is_pkg_set', 'current_version', 'current_versions',
-                  'find_package_file', 'walk_package_files',
-                  'list_active_packages', 'list_package_choices',
-                  'list_package_versions', 'current_package_versions'):
-            g[n] = getattr(self, n)
-
-        # platform utilities
-        import platform
-        # filter local and non-functions
-        g.update([(k, v) for k, v in platform.__dict__.iteritems() \
-                  if not k.startswith('_') and inspect.isfunction(v)])
-
-        try:
-            import setpkgutil
-            utildict = setpkgutil.__dict__.copy()
-            overrides = set(g.keys()).intersection(utildict.keys())
-            for o in overrides:
-                if g[o] is not utildict[o]:
-                    logger.warn("setpkgutil contains object with protected name %r: ignoring" % o)
-                    utildict.pop(o)
-            # filter local
-            g.update([(k, v) for k, v in utildict.iteritems() if not k.startswith('_')])
-        except ImportError:
-            pass
         #logger.debug('%s: execfile %r' % (package.fullname, package.file))
 #        try:
             # add the current version to the environment tracked by this pacakge
@@ -2057,9 +3897,15 @@ class Session(object):
 
         requirements = load('requires', 'DEPENDENCIES', None)
 
-        # Execute the file!
-#        try:
-        execfile(package.file, g)
+        # Execute the file! ...unless it can be replayed
+        import time
+        start = time.time()
+        if self._replay_package(package, g['env'], depth):
+            mode = 'replay'
+        else:
+            self._run_package(package, g)
+            mode = 'run'
+        timing_cache.store((package.file, mode), package.hash, time.time() - start)
 #        except Exception, err:
 #            # TODO: add line and context info for last frame
 #            import traceback
@@ -2114,17 +3960,21 @@ class Session(object):
         shortname = package.name
         curr = PackageInterface(shortname, session=self)
         reloading = False
+        # variables of the previous version of a reloaded package
+        written = set()
         # check if we've already been set:
         if curr.is_active():
             if force:
                 reloading = True
                 self._status('reloading', package.fullname, '+', depth)
-                self.remove_package(curr.name, depth=depth + 1, reloading=True)
+                old = self.remove_package(curr.name, depth=depth + 1, reloading=True)
+                written.update(old.environ_vars())
             else:
                 if curr.hash != package.hash:
                     reloading = True
                     self._status('refreshing', package.fullname, '+', depth)
-                    self.remove_package(curr.name, recurse=True, depth=depth, reloading=True)
+                    old = self.remove_package(curr.name, recurse=True, depth=depth, reloading=True)
+                    written.update(old.environ_vars())
                 # if a package of this type is already active and
                 # A) the version requested is the same OR
                 # B) a specific version was not requested
@@ -2141,7 +3991,8 @@ class Session(object):
                             break
                     if reloading:
                         self._status('reloading', package.fullname, '+', depth)
-                        self.remove_package(curr.name, depth=depth, reloading=True)
+                        old = self.remove_package(curr.name, depth=depth, reloading=True)
+                        written.update(old.environ_vars())
                     else:
                         return package
                 else:
@@ -2149,7 +4000,8 @@ class Session(object):
                     self._status('switching',
                                  '%s --> %s' % (curr.fullname, package.version)
                                  , '+', depth)
-                    self.remove_package(curr.name, depth=depth, reloading=True)
+                    old = self.remove_package(curr.name, depth=depth, reloading=True)
+                    written.update(old.environ_vars())
 
         if not reloading:
             self._status('adding', package.fullname, '+', depth)
@@ -2158,23 +4010,38 @@ class Session(object):
         self._exec_package(package, depth=depth)
 
         del package.versions
-        del package.config
+        # header data is cached on disk; no need to store it in the session
+        for attr in ('config', 'header'):
+            package.__dict__.pop(attr, None)
         self.storage[package.name] = package
 
         if reloading:
             # if we just reloaded this package, also reload the dependents
+            # which use any of its variables, old or new
+            written.update(package.environ_vars())
             for dependent in package.get_dependents():
                 req_ver = package.required_version(dependent.name)
                 if req_ver:
                     if req_ver == package.version:
-                        self.add_package(dependent.fullname, depth=depth + 1, force=True)
+                        self._reload_dependent(dependent, written, depth)
                     else:
                         # TODO: prepend dependent's variables
                         logger.warn('WARNING: %s requires %s' % (dependent.fullname, _joinname(package.name, req_ver)))
                 else:
-                    self.add_package(dependent.fullname, depth=depth + 1, force=True)
+                    self._reload_dependent(dependent, written, depth)
         return package
 
+    def _reload_dependent(self, dependent, names, depth=0):
+        '''
+        reload the active package dependent, unless it is known not to use
+        any of the variables names
+        '''
+        if self._uses_vars(dependent.name, names):
+            self.add_package(dependent.fullname, depth=depth + 1, force=True)
+        else:
+            logger.debug('%s: keeping, it does not use the variables of its '
+                         'reloaded requirement' % dependent.fullname)
+
     def remove_package(self, name, recurse=False, depth=0, reloading=False):
         shortname, version = _splitname(name)
         curr_version = self.current_version(shortname)
@@ -2192,8 +4059,7 @@ class Session(object):
             self._status('removing', package.fullname, '-', depth)
 
         for name, env_var in package.environ_vars().iteritems():
-            for action in reversed(env_var._actions):
-                action.undo(package._environ_obj, name)
+            env_var.undo()
 
         del self.storage[shortname]
         self._removed.append(package)
@@ -2210,10 +4076,213 @@ class Session(object):
                     self.remove_package(depend.fullname, depth=depth + 1)
         return package
 
+    def remove_all(self):
+        '''
+        remove all active packages, and end the session.
+
+        if no variable has been changed by anything else since the session
+        last changed it, the values which the variables had before the first
+        package was set are restored in one step, instead of undoing each
+        package in turn.
+        '''
+        packages = self.list_active_packages()
+        base = self._base
+        state = self._state
+        if base is None or any(_crc(self.environ.get(name)) != state.get(name)
+                               for name in base):
+            logger.debug('session snapshot is missing or out of date: '
+                         'removing packages one at a time')
+            for name in packages:
+                # may already have been removed as a dependent of another
+                if self.is_pkg_set(name):
+                    self.remove_package(name)
+            for key in (self.BASE_KEY, self.STATE_KEY):
+                if key in self.storage:
+                    del self.storage[key]
+            self._initial.clear()
+            return
+
+        for name in packages:
+            self._status('removing', name, '-')
+        stack = self._stack()
+        environ = self.environ
+        for name, value in base.iteritems():
+            if value is None:
+                environ.pop(name, None)
+            else:
+                environ[name] = value
+        for name in environ.keys():
+            if self.BOOKKEEPING_RE.match(name):
+                del environ[name]
+        # nothing is left for the storage to write, except the checkpoints
+        self.__dict__.pop('storage', None)
+        self._initial.clear()
+        self._fresh = False
+        if stack:
+            self.storage[self.STACK_KEY] = stack
+
+    #---------------------------------------------------------------------------
+    # Checkpoints
+    #---------------------------------------------------------------------------
+    # push saves the encoded session storage, and the values of the variables
+    # changed by packages and of the package bookkeeping variables, on a stack
+    # kept in the storage. pop puts them back, so no package is executed.
+    def _stack(self):
+        if self.STACK_KEY in self.storage:
+            return self.storage[self.STACK_KEY]
+        return []
+
+    def push(self):
+        '''
+        save the active packages and the environment as a checkpoint, which
+        can be restored with pop. returns the number of saved checkpoints
+        '''
+        base = self._base
+        if base is None:
+            raise CheckpointError('the session was started by an older version '
+                                  'of setpkg: unset all packages first')
+        storage = self.storage
+        self.flush()
+        environ = self.environ
+        values = dict((name, environ.get(name)) for name in base)
+        for name, value in environ.iteritems():
+            if Package.INTERNAL_VARS_RE.match(name):
+                values[name] = value
+        data = storage.checkpoint(exclude=(self.STACK_KEY,))
+        stack = self._stack() + [(values, data)]
+        storage[self.STACK_KEY] = stack
+        self._status('pushing', 'checkpoint %d' % len(stack), '+')
+        return len(stack)
+
+    def pop(self):
+        '''
+        restore the packages and environment saved by the last push, without
+        executing any package. returns the number of checkpoints left
+        '''
+        stack = self._stack()
+        if not stack:
+            raise CheckpointError('no checkpoint to restore')
+        values, data = stack[-1]
+        stack = stack[:-1]
+
+        current = self.current_versions()
+        versions = dict((name[len(VER_PREFIX):], value.split(META_SEP)[0])
+                        for name, value in values.iteritems()
+                        if name.startswith(VER_PREFIX) and value is not None)
+        for name in sorted(current):
+            if versions.get(name) != current[name]:
+                self._status('removing', _joinname(name, current[name]), '-')
+        for name in sorted(versions):
+            if current.get(name) != versions[name]:
+                self._status('restoring', _joinname(name, versions[name]), '+')
+
+        # variables changed since the push, which it did not save, had the
+        # value they had before any package was set
+        environ = self.environ
+        targets = dict(self._base or {})
+        targets.update(values)
+        for name in environ.keys():
+            if Package.INTERNAL_VARS_RE.match(name) and name not in values:
+                targets[name] = None
+        for name, value in targets.iteritems():
+            if value is None:
+                environ.pop(name, None)
+            else:
+                environ[name] = value
+        self.storage.restore(data, exclude=(self.STACK_KEY,))
+        if stack:
+            self.storage[self.STACK_KEY] = stack
+        else:
+            del self.storage[self.STACK_KEY]
+
+        # the snapshot was restored along with the storage
+        self._initial.clear()
+        self._fresh = False
+        self._base_changed = False
+        self.__dict__.pop('_base', None)
+        self.__dict__.pop('_state', None)
+        self._status('popping', 'checkpoint %d' % (len(stack) + 1), '-')
+        return len(stack)
+
+    #---------------------------------------------------------------------------
+    # Snapshot
+    #---------------------------------------------------------------------------
+    # The first time a variable is changed by any package, its value is noted
+    # in the session's snapshot, so that remove_all can restore them all at
+    # once. Checksums of the values the session leaves the variables with are
+    # saved too, so that remove_all can tell when something else has changed
+    # them since.
+    def _snapshot(self, name):
+        '''
+        note the value of the variable name, before the session changes it
+        '''
+        if self._fresh is None:
+            # decided before the session changes anything
+            self._fresh = not self.current_versions()
+        if name in self._initial or self.BOOKKEEPING_RE.match(name):
+            return
+        value = self.environ.get(name)
+        self._initial[name] = value
+        base = self._base
+        if base is not None and name not in base:
+            base[name] = value
+            self._base_changed = True
+
+    @propertycache
+    def _base(self):
+        '''
+        {name : value} of the variables as they were before any package was
+        set, or None if the session was started by a version of setpkg which
+        did not keep them
+        '''
+        if self._fresh is None:
+            self._fresh = not self.current_versions()
+        if self._fresh:
+            return {}
+        if self.BASE_KEY in self.storage:
+            return self.storage[self.BASE_KEY]
+        return None
+
+    @propertycache
+    def _state(self):
+        '''
+        {name : checksum} of the values the session last left the variables of
+        the snapshot with
+        '''
+        if not self._fresh and self.STATE_KEY in self.storage:
+            return self.storage[self.STATE_KEY]
+        return {}
+
+    def _save_snapshot(self):
+        base = self._base
+        if base is None:
+            return
+        if self._fresh or self._base_changed:
+            self.storage[self.BASE_KEY] = base
+        old_state = self._state
+        state = dict(old_state)
+        for name, value in self._initial.iteritems():
+            # a variable which was changed by something else since the session
+            # last saw it keeps its stale checksum
+            if name not in old_state or old_state[name] == _crc(value):
+                state[name] = _crc(self.environ.get(name))
+        if self._fresh or state != old_state:
+            self.storage[self.STATE_KEY] = state
+
     @propertycache
     def storage(self):
         return self.storage_class(self)
 
+    def flush(self):
+        '''
+        save any pending changes to the session storage
+        '''
+        # don't create the storage just to flush it
+        if 'storage' in self.__dict__:
+            if self._fresh or self._initial:
+                self._save_snapshot()
+            self.storage.flush()
+
     @property
     def added(self):
         return self._added
@@ -2226,6 +4295,10 @@ class Session(object):
         if other is None:
             other = os.environ
 
+        if isinstance(self.environ, OverlayEnviron) and self.environ.base is other:
+            # only the variables in the overlay can differ
+            return self.environ.changes()
+
         # we'll be modifying this, make a copy
         removed = dict(other)
         changed = {}
@@ -2250,6 +4323,10 @@ class Session(object):
             raise ValueError('SETPKG_PATH environment variable not set!')
         return _split(self.environ['SETPKG_PATH'])
 
+    @DefaultSessionMethod
+    def _pkgdirs(self):
+        return [_expand(path) for path in self._pkgpaths()]
+
     @DefaultSessionMethod
     def _current_data(self, name):
         '''
@@ -2320,22 +4397,74 @@ class Session(object):
         name : str
             A versioned or unversioned package name
         '''
-        for path in self._pkgpaths():
-            file = os.path.join(_expand(path), (name + '.pykg'))
-            if os.path.exists(file):
-                return file
-        raise PackageError(name, 'unknown package')
+        file = package_index.find(self._pkgdirs(), name)
+        if file is None:
+            raise PackageError(name, 'unknown package')
+        self._package_files.add(file)
+        return file
 
     @DefaultSessionMethod
     def walk_package_files(self):
         # Accomodate for hiearchical setpkg paths - if we've already encountered
         # a given .pykg, don't yield a new one
         discovered = set()
-        for path in self._pkgpaths():
-            for f in sorted(os.listdir(path)):
-                if f.endswith('.pykg') and f not in discovered:
+        for path in self._pkgdirs():
+            for f in package_index.listing(path):
+                if f not in discovered:
                     discovered.add(f)
-                    yield os.path.join(path, f)
+                    file = os.path.join(path, f)
+                    self._package_files.add(file)
+                    yield file
+
+    @DefaultSessionMethod
+    def system_alias_script(self, shell_name=None):
+        '''
+        return the commands which create the system aliases of all packages on
+        the SETPKG_PATH for the given shell.
+
+        the script is cached, and written to `system_alias_file` for the
+        startup scripts to source, until a .pykg file is added, removed or
+        modified.
+        '''
+        if shell_name is None:
+            shell_name = get_shell_name()
+        shell_name = os.path.basename(shell_name)
+        setpkg_path = self.environ.get('SETPKG_PATH', '')
+        package_files = sorted(self.walk_package_files())
+        fingerprint = (platform_facts.system(),
+                       [_stat_fingerprint(d) for d in self._pkgdirs()],
+                       [_stat_fingerprint(f) for f in package_files])
+        key = (shell_name, setpkg_path)
+        filename = system_alias_file(shell_name, setpkg_path)
+        script = alias_cache.lookup(key, fingerprint)
+        if script is not None and (os.path.exists(filename) or
+                                   not PersistentCache.enabled()):
+            return script
+
+        shell = get_shell_class(shell_name)()
+        lines = []
+        complete = True
+        for package_file in package_files:
+            try:
+                pkg = Package(package_file, session=self)
+                for sys_alias, cmd in pkg.system_aliases:
+                    lines.append(shell.alias(sys_alias, cmd))
+            except PackageError, err:
+                logger.debug(str(err))
+            except Exception:
+                logger.error('Unknown error reading aliases for package %s:' % package_file)
+                import traceback
+                logger.error(traceback.format_exc())
+                complete = False
+        script = ''.join(line + '\n' for line in lines)
+        if complete:
+            alias_cache.store(key, fingerprint, script)
+            if PersistentCache.enabled():
+                try:
+                    _write_atomic(filename, script)
+                except (IOError, OSError), e:
+                    logger.debug('could not write %s: %s' % (filename, e))
+        return script
 
     @DefaultSessionMethod
     def list_active_packages(self, package=None, pid=None):
@@ -2351,7 +4480,7 @@ class Session(object):
 
     @DefaultSessionMethod
     def list_package_choices(self, package=None, versions=True, aliases=False,
-                             regexp=False):
+                             regexp=False, prefix=None):
         '''
         list available packages in NAME-VERSION format.
 
@@ -2367,26 +4496,52 @@ class Session(object):
         regexp : bool
             If versions is True, and versions-from-regexp is enabled, whether to list
             this regexp in the versions as well
+        prefix : str
+            Only list choices starting with this string.  if it contains a
+            version (ie, 'maya-'), only that package's file is read.
 
         '''
         packages = []
         if package:
             package_files = [self.find_package_file(package)]
+        elif prefix and _hasversion(prefix):
+            package_file = package_index.find(self._pkgdirs(), _shortname(prefix))
+            package_files = [package_file] if package_file else []
         else:
             package_files = sorted(self.walk_package_files())
+            if prefix:
+                package_files = [f for f in package_files if
+                                 os.path.basename(f).startswith(_shortname(prefix))]
 
         if not versions:
-            return [ os.path.splitext(os.path.basename(file))[0] for file in package_files]
+            packages = [os.path.splitext(os.path.basename(file))[0] for file in package_files]
+        else:
+            for package_file in package_files:
+                try:
+                    name = os.path.splitext(os.path.basename(package_file))[0]
+                    choices = self._package_file_choices(package_file, aliases, regexp)
+                    packages.extend(_joinname(name, ver) for ver in choices)
+                except PackageError, err:
+                    logger.debug(str(err))
+        if prefix:
+            packages = [p for p in packages if p.startswith(prefix)]
+        return packages
 
-        for package_file in package_files:
-            try:
-                pkg = Package(package_file, session=self)
-                versions = self.list_package_versions(package=pkg, aliases=aliases,
+    @DefaultSessionMethod
+    def _package_file_choices(self, package_file, aliases=False, regexp=False):
+        '''
+        return the versions listed by list_package_versions for package_file,
+        served from the completion cache while the file is unchanged
+        '''
+        key = (package_file, aliases, regexp, platform_facts.system())
+        fingerprint = _stat_fingerprint(package_file)
+        choices = completion_cache.lookup(key, fingerprint)
+        if choices is None:
+            pkg = Package(package_file, session=self)
+            choices = self.list_package_versions(package=pkg, aliases=aliases,
                                                  regexp=regexp)
-                packages.extend(_joinname(pkg.name, ver) for ver in versions)
-            except PackageError, err:
-                logger.debug(str(err))
-        return packages
+            completion_cache.store(key, fingerprint, choices)
+        return choices
 
     @DefaultSessionMethod
     def list_package_versions(self, package=None, package_file=None,
@@ -2445,10 +4600,329 @@ class Session(object):
             result.append(package)
         return result
 
+    #===========================================================================
+    # Planning
+    #===========================================================================
+
+    def plan(self, packages, force=False, args=()):
+        '''
+        return a `Plan` of the changes which adding the given packages, in
+        order, would make to this session, without making them.
+
+        Parameters
+        ----------
+        packages : list of str
+            versioned or unversioned package names
+        force : bool
+            plan to reload the packages even if they are already set
+        args : tuple
+            additional arguments for the last package
+        '''
+        plan = Plan(self)
+        for i, name in enumerate(packages):
+            plan.add(name, force=force, args=args if i == len(packages) - 1 else ())
+        return plan
+
+    def apply(self, plan):
+        '''
+        add the packages requested by plan. the session should not have been
+        modified since the plan was made.
+        '''
+        packages = []
+        for name, force, args in plan.requests:
+            packages.append(self.add_package(name, force=force, args=args))
+        return packages
+
+#===============================================================================
+# Plans
+#===============================================================================
+
+class PlanStep(object):
+    '''
+    A change to a package which a `Plan` predicts
+    '''
+    # actions which execute (or replay) the package body
+    EXECUTING = ('adding', 'switching', 'reloading', 'refreshing')
+
+    def __init__(self, action, label, symbol, depth, mode=None, seconds=None):
+        self.action = action
+        self.label = label
+        self.symbol = symbol
+        self.depth = depth
+        # 'run' or 'replay' for the executing actions
+        self.mode = mode
+        # duration of the last run or replay of the package, if known
+        self.seconds = seconds
+
+    def __repr__(self):
+        return '%s(%r, %r)' % (self.__class__.__name__, self.action, self.label)
+
+    def __str__(self):
+        prefix = '[%s]  ' % self.symbol + ('  ' * self.depth)
+        line = ('%s:' % self.action).ljust(12) + prefix + self.label
+        if self.mode:
+            if self.seconds is None:
+                cost = '?'
+            else:
+                cost = '%.1f ms' % (self.seconds * 1000)
+            line = '%s %s %10s' % (line.ljust(50), self.mode.ljust(6), cost)
+        return line
+
+class Plan(object):
+    '''The steps which setting packages in a session will take
+
+    A plan is made by `Session.plan` from the package headers, and the state
+    of the session, without executing any package, and is carried out by
+    `Session.apply`. It follows the same rules as `Session.add_package`: the
+    requirements and sub-packages of each package are planned in the order in
+    which they would be set, and a package which is already planned is not
+    planned again, however many packages require it (see `shared`).
+
+    Sub-packages which a package body sets by calling ``setpkg`` are only known
+    if the package has a replay journal (see `Session._replay_package`).
+    Otherwise, they are discovered when the plan is applied. Likewise, the
+    dependents of a reloaded package are planned to be reloaded unless its
+    journal shows that they do not use its variables (see
+    `Session._uses_vars`); if they call session methods, they are assumed to.
+    What a package reads is recorded each time it is executed, even if it does
+    not enable ``replay`` or ``SETPKG_NO_REPLAY`` is set, so `Session.apply`
+    keeps such dependents. But the variables which the new version of the
+    reloaded package will write are only known from its journal, so unless it
+    can be replayed, the plan lists its dependents as reloaded.
+    '''
+    def __init__(self, session):
+        self.session = session
+        # (name, force, args) for each package requested
+        self.requests = []
+        self.steps = []
+        self.errors = []
+        self.warnings = []
+        # {shortname : number of times it was required after it was planned}
+        self.shared = {}
+        # the simulated state of the session:
+        # {shortname : (version, hash), or None if removed}
+        self._active = {}
+        # {shortname : [dependent shortname, ...]}
+        self._dependents = {}
+        # {shortname : {dependency shortname : required version or None}}
+        self._dependencies = {}
+        self._planned = set()
+
+    def __str__(self):
+        return '\n'.join([str(step) for step in self.steps] + [self.summary()])
+
+    def add(self, name, force=False, args=()):
+        '''
+        plan to add the package name, as `Session.add_package`
+        '''
+        self.requests.append((name, force, args))
+        self._add(name, force=force, args=args)
+
+    def executing(self):
+        return [step for step in self.steps if step.action in PlanStep.EXECUTING]
+
+    def estimate(self):
+        '''
+        return the estimated time in seconds that applying the plan will spend
+        in package bodies, and the number of packages with no estimate
+        '''
+        seconds = 0.0
+        unknown = 0
+        for step in self.executing():
+            if step.seconds is None:
+                unknown += 1
+            else:
+                seconds += step.seconds
+        return seconds, unknown
+
+    def summary(self):
+        counts = {}
+        for step in self.steps:
+            counts[step.action] = counts.get(step.action, 0) + 1
+        modes = [step.mode for step in self.executing()]
+        seconds, unknown = self.estimate()
+        parts = ['%d %s' % (counts[action], action)
+                 for action in PlanStep.EXECUTING + ('removing',) if action in counts]
+        if not parts:
+            return 'plan: nothing to do'
+        line = 'plan: %s; %d run, %d replayed; estimated %.1f ms' % (
+            ', '.join(parts), modes.count('run'), modes.count('replay'),
+            seconds * 1000)
+        if unknown:
+            line += ' (+ %d without an estimate)' % unknown
+        if self.shared:
+            line += '\nshared: ' + ', '.join('%s (%d)' % item for item in sorted(self.shared.items()))
+        return line
+
+    #---------------------------------------------------------------------------
+    # Simulation
+    #---------------------------------------------------------------------------
+
+    def _current(self, name):
+        if name in self._active:
+            return self._active[name]
+        version, hash = self.session._current_data(name)
+        if version is None:
+            return None
+        return (version, hash)
+
+    def _get_dependents(self, name):
+        if name not in self._dependents:
+            value = self.session.environ.get('SETPKG_DEPENDENTS_%s' % name)
+            self._dependents[name] = _split(value) if value else []
+        return self._dependents[name]
+
+    def _get_dependencies(self, name):
+        if name not in self._dependencies:
+            value = self.session.environ.get('SETPKG_DEPENDENCIES_%s' % name)
+            self._dependencies[name] = dict(_splitname(pkg) for pkg in _split(value)) if value else {}
+        return self._dependencies[name]
+
+    def _journal(self, package):
+        session = self.session
+        if not session._can_replay(package):
+            return None
+        key, fingerprint = session._journal_key(package)
+        return journal_cache.lookup(key, fingerprint)
+
+    def _written(self, package, requirements, journal):
+        '''
+        return the variables written by the active version of package and
+        by the version which will replace it, or None if they are not known
+        '''
+        if journal is None:
+            return None
+        try:
+            old = self.session.storage[package.name]
+        except KeyError:
+            return None
+        written = set(old.environ_vars())
+        written.update(name for kind, name, value, extra in journal
+                       if kind not in ('read', 'call', 'setpkg'))
+        written.add(VER_PREFIX + package.name)
+        written.add('SETPKG_DEPENDENCIES_%s' % package.name)
+        written.update('SETPKG_DEPENDENTS_%s' % _splitname(pkg)[0] for pkg in requirements)
+        return written
+
+    def _step(self, action, label, symbol, depth, package=None, mode=None):
+        seconds = None
+        if package is not None:
+            seconds = timing_cache.lookup((package.file, mode), package.hash)
+        self.steps.append(PlanStep(action, label, symbol, depth, mode, seconds))
+
+    def _add(self, name, force=False, args=(), depth=0):
+        try:
+            package = self.session.get_package(name, args)
+            package.version
+        except PackageError, err:
+            self.errors.append(str(err))
+            return
+        shortname = package.name
+        journal = self._journal(package)
+        mode = 'run' if journal is None else 'replay'
+        curr = self._current(shortname)
+        reloading = False
+        if curr is not None:
+            curr_version, curr_hash = curr
+            if force:
+                reloading = True
+                self._step('reloading', package.fullname, '+', depth, package, mode)
+                self._remove(shortname, depth=depth + 1, reloading=True)
+            elif curr_hash != package.hash:
+                reloading = True
+                self._step('refreshing', package.fullname, '+', depth, package, mode)
+                self._remove(shortname, recurse=True, depth=depth, reloading=True)
+            elif not package.explicit_version or curr_version == package.version:
+                for dep, version in self._get_dependencies(shortname).iteritems():
+                    dep_curr = self._current(dep)
+                    if dep_curr is None:
+                        self.errors.append(str(PackageRemovedError(dep)))
+                        return
+                    if version and dep_curr[0] != version:
+                        reloading = True
+                        break
+                if not reloading:
+                    if shortname in self._planned:
+                        self.shared[shortname] = self.shared.get(shortname, 0) + 1
+                    return package
+                self._step('reloading', package.fullname, '+', depth, package, mode)
+                self._remove(shortname, depth=depth, reloading=True)
+            else:
+                reloading = True
+                self._step('switching',
+                           '%s --> %s' % (_joinname(shortname, curr_version), package.version),
+                           '+', depth, package, mode)
+                self._remove(shortname, depth=depth, reloading=True)
+
+        if not reloading:
+            self._step('adding', package.fullname, '+', depth, package, mode)
+        self._active[shortname] = (package.version, package.hash)
+        self._planned.add(shortname)
+
+        requirements = package._read_packagelist('requires')
+        for pkg in requirements:
+            self._add(pkg, depth=depth + 1)
+        # packages set by the body
+        for kind, subname, subargs, extra in journal or ():
+            if kind == 'setpkg':
+                self._add(subname, args=subargs, depth=depth + 1)
+        for pkg in package.subpackages:
+            self._add(pkg, depth=depth + 1)
+
+        for pkg in requirements:
+            dependents = self._get_dependents(_splitname(pkg)[0])
+            if shortname not in dependents:
+                dependents.append(shortname)
+        self._dependencies[shortname] = dict(_splitname(pkg) for pkg in requirements)
+
+        if reloading:
+            written = self._written(package, requirements, journal)
+            for dependent in list(self._get_dependents(shortname)):
+                dep_curr = self._current(dependent)
+                if dep_curr is None:
+                    continue
+                fullname = _joinname(dependent, dep_curr[0])
+                req_ver = self._get_dependencies(dependent).get(shortname)
+                if req_ver and req_ver != package.version:
+                    self.warnings.append('%s requires %s' % (fullname, _joinname(shortname, req_ver)))
+                # the results of session queries can't be predicted, so
+                # assume that they will change
+                elif written is None or self.session._uses_vars(dependent, written, queries=True):
+                    self._add(fullname, force=True, depth=depth + 1)
+        return package
+
+    def _remove(self, name, recurse=False, depth=0, reloading=False):
+        shortname = _splitname(name)[0]
+        curr = self._current(shortname)
+        if curr is None:
+            return
+        version = curr[0]
+        if not reloading:
+            self._step('removing', _joinname(shortname, version), '-', depth)
+        self._active[shortname] = None
+        for dep in self._get_dependencies(shortname):
+            dependents = self._get_dependents(dep)
+            if shortname in dependents:
+                dependents.remove(shortname)
+        self._dependencies[shortname] = {}
+
+        if recurse:
+            try:
+                subs = Package(self.session.find_package_file(shortname), version,
+                               session=self.session).subpackages
+            except PackageError:
+                subs = []
+            for sub in subs:
+                self._remove(sub, recurse, depth + 1)
+        elif not reloading:
+            for dependent in list(self._get_dependents(shortname)):
+                if self._current(dependent) is not None:
+                    self._remove(dependent, depth=depth + 1)
 
 def _update_environ(session, other=None):
     if other is None:
         other = os.environ
+    session.flush()
     changed, removed = session.altered(other=other)
     for key, val in changed.iteritems():
         other[key] = val
@@ -2460,21 +4934,141 @@ def setpkg(package, force=False, pid=None, environ=None, pkgflags=()):
     '''
     Parameters
     ----------
+    package : str or list of str
+        package(s) to set. multiple packages are set in order in a single
+        session, so requirements which they share are only set once, and the
+        session is only saved once
     force : bool
         Set to True if package should be reloaded
     environ: dict
         dictionary of environment variables.  Defaults to os.environ
+    pkgflags : tuple
+        additional arguments for the package, or for the last package if
+        several are given
     '''
     logger.debug('setpkg %s' % ([force, pid, sys.executable]))
+    if isinstance(package, basestring):
+        packages = [package]
+    else:
+        packages = list(package)
 
     if environ is None:
         environ = os.environ
 
-    session = Session(pid=pid, environ=dict(environ))
-    session.add_package(package, force=force, args=pkgflags)
+    session = Session(pid=pid, environ=OverlayEnviron(environ))
+    for i, name in enumerate(packages):
+        args = pkgflags if i == len(packages) - 1 else ()
+        session.add_package(name, force=force, args=args)
 
     return _update_environ(session, other=environ)
 
+# variables which the shell or the terminal change as the user works. they are
+# left out of the key of resolvepkg's cache, so that running the same package
+# from another directory or shell can reuse it, unless a package reads them.
+_VOLATILE_VARS = frozenset(['PWD', 'OLDPWD', 'SHLVL', '_', 'TERM', 'TERMCAP',
+                            'COLUMNS', 'LINES', 'WINDOWID', 'SSH_TTY', 'STY',
+                            'WINDOW', 'TMUX_PANE', 'JOB_ID', 'LSB_JOBID',
+                            'PBS_JOBID', 'SLURM_JOB_ID'])
+
+# session data, which is only checksummed in resolvepkg's cache key
+_SESSION_DATA_RE = re.compile('^SETPKG_SESSION_(?:PKG|DATA)_')
+
+def _resolution_key(package, pkgflags, environ):
+    import hashlib
+    items = []
+    for k, v in environ.iteritems():
+        # the session variable only records the pid of the shell, which
+        # resolvepkg substitutes
+        if k == SessionStorage.SESSION_VAR or k in _VOLATILE_VARS:
+            continue
+        if _SESSION_DATA_RE.match(k):
+            # the undo data of the active packages can change the result, but
+            # there is no need to hash all of it
+            v = _crc(v)
+        items.append((k, v))
+    items.sort()
+    return hashlib.sha1(repr((package, tuple(pkgflags), items))).hexdigest()
+
+def _uses_volatile_vars(session):
+    '''
+    return whether any package added to the session read or changed one of the
+    variables left out of the resolution key, or did not record what it did
+    '''
+    for package in session.added:
+        if not isinstance(package, Package):
+            continue
+        inputs = getattr(package, '_observed', None)
+        written = getattr(package, '_written', None)
+        if inputs is None or written is None:
+            return True
+        if _VOLATILE_VARS.intersection(inputs[0]) or _VOLATILE_VARS.intersection(written):
+            return True
+    return False
+
+def planpkg(package, force=False, pid=None, environ=None, pkgflags=()):
+    '''
+    Return a `Plan` of what `setpkg` would do with the same arguments, without
+    changing the environment or executing any package.
+    '''
+    logger.debug('planpkg %s' % ([force, pid, sys.executable]))
+    if isinstance(package, basestring):
+        package = [package]
+
+    if environ is None:
+        environ = os.environ
+
+    session = Session(pid=pid, environ=OverlayEnviron(environ))
+    return session.plan(package, force=force, args=pkgflags)
+
+def resolvepkg(package, pid=None, environ=None, pkgflags=()):
+    '''
+    Set a package, like `setpkg`, but reuse the changes made by an earlier
+    call with the same package and environment, if none of the package files
+    involved have changed since. Intended for non-interactive uses, such as
+    `runpkg`, which repeatedly set the same packages in the same environment.
+
+    Only packages which enable ``replay`` in their main section are cached. The
+    key leaves out variables which the shell changes as the user works, such as
+    ``PWD`` and ``SHLVL``, so packages which read or change them are not
+    cached either.
+
+    Returns
+    -------
+    (changed, removed) : dictionaries of the environment variables which were
+    changed and removed
+    '''
+    logger.debug('resolvepkg %s' % ([package, pid, sys.executable]))
+
+    if environ is None:
+        environ = os.environ
+
+    key = _resolution_key(package, pkgflags, environ)
+    cached = resolution_cache.get(key)
+    if cached is None:
+        session = Session(pid=pid, environ=OverlayEnviron(environ))
+        pkg = session.add_package(package, args=pkgflags)
+        changed, removed = _update_environ(session, other=environ)
+        if (pkg is not None and all(getattr(p, 'replay', True) for p in session.added)
+                and not _uses_volatile_vars(session)):
+            resolution_cache.put(key, session._pkgdirs(), session._package_files,
+                                 (changed.copy(), removed.copy()))
+        return changed, removed
+
+    logger.debug('%s: using cached resolution %s' % (package, key))
+    changed, removed = cached
+    changed = changed.copy()
+    removed = removed.copy()
+    session_pid = str(pid if pid else _getppid())
+    if environ.get(SessionStorage.SESSION_VAR) == session_pid:
+        changed.pop(SessionStorage.SESSION_VAR, None)
+    else:
+        changed[SessionStorage.SESSION_VAR] = session_pid
+    for name, val in changed.iteritems():
+        environ[name] = val
+    for name in removed:
+        environ.pop(name, None)
+    return changed, removed
+
 def runpkg(package, args, executable=None, force=False, pid=None, environ=None):
     '''
     Ensure a package is set, then execute it in a subprocess with optional args
@@ -2495,16 +5089,74 @@ def runpkg(package, args, executable=None, force=False, pid=None, environ=None):
     if environ is None:
         environ = os.environ
 
-    session = Session(pid=pid, environ=dict(environ))
-    packageClass = session.add_package(package, force=force)
-    _update_environ(session, other=environ)
+    if force:
+        session = Session(pid=pid, environ=OverlayEnviron(environ))
+        session.add_package(package, force=force)
+        _update_environ(session, other=environ)
+    else:
+        resolvepkg(package, pid=pid, environ=environ)
 
     # if no specific executable is specified, just assume the executable from
     # the first package class in the list.
-    executable = executable if executable else packageClass.executable
+    if not executable:
+        executable = Session(pid=pid, environ=environ).get_package(package).executable
     exeAndArgs = (executable,) + args
     return executableOutput(exeAndArgs)
 
+def pushpkg(pid=None, environ=None):
+    '''
+    save the active packages and the environment as a checkpoint, which
+    poppkg restores. see Session.push
+
+    Parameters
+    ----------
+    environ: dict
+        dictionary of environment variables.  Defaults to os.environ
+    '''
+    logger.debug('pushpkg %s' % ([pid, sys.executable]))
+    if environ is None:
+        environ = os.environ
+
+    session = Session(pid=pid, environ=OverlayEnviron(environ))
+    session.push()
+    return _update_environ(session, other=environ)
+
+def poppkg(pid=None, environ=None):
+    '''
+    restore the packages and environment saved by the last pushpkg, without
+    executing any package. see Session.pop
+
+    Parameters
+    ----------
+    environ: dict
+        dictionary of environment variables.  Defaults to os.environ
+    '''
+    logger.debug('poppkg %s' % ([pid, sys.executable]))
+    if environ is None:
+        environ = os.environ
+
+    session = Session(pid=pid, environ=OverlayEnviron(environ))
+    session.pop()
+    return _update_environ(session, other=environ)
+
+def unsetallpkg(pid=None, environ=None):
+    '''
+    remove all active packages, restoring the environment as it was before
+    the first package was set. see Session.remove_all
+
+    Parameters
+    ----------
+    environ: dict
+        dictionary of environment variables.  Defaults to os.environ
+    '''
+    logger.debug('unsetallpkg %s' % ([pid, sys.executable]))
+    if environ is None:
+        environ = os.environ
+
+    session = Session(pid=pid, environ=OverlayEnviron(environ))
+    session.remove_all()
+    return _update_environ(session, other=environ)
+
 def unsetpkg(packages, recurse=False, pid=None, environ=None):
     '''
     Parameters
@@ -2518,7 +5170,7 @@ def unsetpkg(packages, recurse=False, pid=None, environ=None):
     if environ is None:
         environ = os.environ
 
-    session = Session(pid=pid, environ=dict(environ))
+    session = Session(pid=pid, environ=OverlayEnviron(environ))
     # Assert that, initially, all packages are active
     for name in packages:
         if not session.is_pkg_set(name):
@@ -0,0 +1,626 @@
+"""
+The ``pkg`` command-line utility.
+
+``bin/setpkgcli`` is a thin wrapper around `main`, so that this module is
+byte-compiled like the rest of setpkg, and can be imported by the resolver
+daemon.
+"""
+import sys
+import os
+
+from setpkg import *
+from setpkg import _splitname
+
+import argparse
+
+# stdout is reserved for commands to be evaluated by the calling shell. set by
+# main.
+saved_stdout = sys.stdout
+
+#===============================================================================
+# Formatter which prints some more information with the usage, for people
+# used the old behavior of 'setpkg'
+#===============================================================================
+class ExtraUsageInfoFormatter(argparse.HelpFormatter):
+    # Subclass and set this to something informative, and it will be appended
+    # the usage string...
+    extra_usage = ''''''
+
+    def _format_usage(self, *args, **kwargs):
+        return super(ExtraUsageInfoFormatter, self)._format_usage(*args, **kwargs) + self.extra_usage
+
+class PkgHelpFormatter(ExtraUsageInfoFormatter):
+    extra_usage = '''
+For a list of all available packages: pkg ls --all
+For a list of all currently set:      pkg ls
+For help setting packages:            pkg set -h / setpkg -h
+For help with other package commands: pkg -h
+------------------------------------------------------------
+'''
+
+default_color_enable=True
+enable_color=default_color_enable
+
+# start and stop parameters for effects
+_effects = {'none': 0, 'black': 30, 'red': 31, 'green': 32, 'yellow': 33,
+            'blue': 34, 'magenta': 35, 'cyan': 36, 'white': 37, 'bold': 1,
+            'italic': 3, 'underline': 4, 'inverse': 7,
+            'black_background': 40, 'red_background': 41,
+            'green_background': 42, 'yellow_background': 43,
+            'blue_background': 44, 'purple_background': 45,
+            'cyan_background': 46, 'white_background': 47}
+
+def render_effects(text, effects):
+    'Wrap text in commands to turn on each effect.'
+    if not text or not enable_color:
+        return text
+    start = [str(_effects[e]) for e in ['none'] + effects.split()]
+    start = '\033[' + ';'.join(start) + 'm'
+    stop = '\033[' + str(_effects['none']) + 'm'
+    return ''.join([start, text, stop])
+
+def _get_shell(shell, *args, **kwargs):
+    try:
+        cls = get_shell_class(shell)
+        return cls(*args, **kwargs)
+    except KeyError, e:
+        logger.error('unknown shell: %s (%s)' % (shell, e.args[0]))
+        sys.exit(1)
+
+def command(value):
+    saved_stdout.write(value + '\n')
+
+# TODO: move this to the Shell class
+def error(value):
+    sys.__stderr__.write('%s\n' % value)
+
+# using this kills whitespace formatting!
+def status(value):
+    saved_stdout.write("echo '%s';\n" % value)
+
+
+def push_checkpoint(args):
+    def f():
+        return pushpkg(pid=args.pid)
+    doit(f, args)
+
+def pop_checkpoint(args):
+    def f():
+        return poppkg(pid=args.pid)
+    doit(f, args)
+
+def list_packages(args):
+    if args.all:
+        for pkg in Session.list_package_choices(args.packages,
+                                              versions=not args.base,
+                                              aliases=args.aliases,
+                                              regexp=not args.no_regexp,
+                                              prefix=args.prefix):
+            status(pkg)
+    else:
+        for pkg in Session.list_active_packages(args.packages, args.pid):
+            status(pkg)
+
+def doit(func, args):
+    set_global = platform_facts.system() == 'Windows' and args.set_global
+    shell = _get_shell(args.shell, set_global=set_global)
+    logger.debug('setpkg start')
+    try:
+        changed, removed = func()
+    except PackageError, err:
+        sys.stderr.write(str(err) + '\n')
+        sys.exit(0)
+    except Exception, err:
+        import traceback
+        logger.error(traceback.format_exc())
+        traceback.print_exc(file=sys.stderr)
+        sys.exit(0)
+    logger.debug('changed variables: %s' % (sorted(changed),))
+    cmds = []
+    for name, value in changed.iteritems():
+        cmds.append(shell.setenv(name, value))
+    for name in removed:
+        cmds.append(shell.unsetenv(name))
+
+    for cmd in cmds:
+        command(cmd)
+        logger.debug(cmd)
+
+def _set_packages(args):
+    '''
+    return the packages and the package arguments of a ``pkg set`` command.
+
+    words after the package are arguments for it, unless they are more packages
+    ended by ``--`` (ie, ``pkg set a b c -- ARGS``), in which case the arguments
+    after the ``--`` go to the last package.
+    '''
+    words = args.args
+    if '--' in words:
+        i = words.index('--')
+        if i and not any(word.startswith('-') for word in words[:i]):
+            return args.package + words[:i], words[i + 1:]
+    return args.package, words
+
+def set_package(args):
+    packages, pkgflags = _set_packages(args)
+    if args.dry_run:
+        plan = planpkg(packages, force=args.reload, pid=args.pid, pkgflags=pkgflags)
+        for msg in plan.errors:
+            error(msg)
+        for msg in plan.warnings:
+            error('WARNING: ' + msg)
+        error(str(plan))
+        return
+    def f():
+        return setpkg(packages, force=args.reload, pid=args.pid, pkgflags=pkgflags)
+    doit(f, args)
+
+def unset_packages(args):
+    def f():
+        if args.all:
+            return unsetallpkg(pid=args.pid)
+        return unsetpkg(args.packages, pid=args.pid, recurse=args.recurse)
+    doit(f, args)
+
+def run_package(args):
+    def f():
+        return resolvepkg(args.package[0], pid=args.pid, pkgflags=args.args)
+    doit(f, args)
+    # Because we know we won't be modifying anything with this session / package,
+    # ok to use os.environ for speed (to avoid copy of environ)
+    package = Session(environ=os.environ).get_package(args.package[0])
+    runcmd = [package.executable]
+    if args.runargs:
+        runcmd.extend(args.runargs)
+    command(' '.join(runcmd))
+
+def info(args):
+    # use raw os.environ for speed
+    session = Session(environ=os.environ, pid=args.pid)
+
+    shortname, version = _splitname(args.package[0])
+    curr_version = session.current_version(shortname)
+    if curr_version is None:
+        package = session.get_package(args.package[0])
+    else:
+        package = session.storage[shortname]
+
+    def detail(*data, **kwargs):
+        colors = kwargs.get('colors', ('cyan',))
+        default_color = kwargs.get('default_color', None)
+        if len(colors) < len(data):
+            colors += ( (default_color,) * (len(data) - len(colors)) )
+
+        widths = kwargs.get('widths', (20, 30))
+        default_width = kwargs.get('default_width', 20)
+        if len(widths) < len(data):
+            widths += ( (default_width,) * (len(data) - len(widths)) )
+
+        data = list(data)
+        if data and data[0]:
+            data[0] += ':'
+        line = ''
+        for d, w, c in zip(data, widths, colors):
+            d = d.ljust(w)
+            if c:
+                d = render_effects(d, c)
+            line += d
+        # user error to avoid removing whitespace formatting
+        error(line)
+
+    def table(section, labels, columns, **kwargs):
+        detail(section, default_color='blue', *['[%s]' % label for label in labels])
+        for data in columns:
+            detail('', *data, **kwargs)
+        status('')
+
+    if version:
+        # resolve alias to real version
+        version = package.aliases.get(version, version)
+        aliases = dict([(a, v) for a,v in package.aliases.items() if v==version])
+    else:
+        aliases = package.aliases
+    defaultVer = package.default_version
+    defaultVer = aliases.get(defaultVer, defaultVer)
+
+    detail('name', package.name)
+    detail('executable', package.executable)
+    detail('versions', ', '.join(session.list_package_versions(package, regexp=True)))
+    detail('default version', str(defaultVer))
+    if curr_version:
+        detail('active version', curr_version, colors=('cyan bold', 'green bold'))
+    else:
+        detail('active version', '<inactive>', colors=('cyan bold',), default_color='red')
+    detail('subpackages', ', '.join(package.subpackages))
+    detail('dependencies', ', '.join([pkg.origname for pkg in package.get_dependencies()]))
+
+    if curr_version:
+        detail('dependents', ', '.join([pkg.origname for pkg in package.get_dependents()]))
+    else:
+        detail('dependents', '<inactive>', default_color='red')
+    status('')
+
+    sys_aliases = package.system_aliases
+    if sys_aliases:
+        table('run commands',
+              ['command', 'action'],
+              [(sys_alias, 'runpkg %s' % pkgname) for sys_alias, pkgname in sys_aliases])
+    else:
+        detail('aliases', '<none>')
+        status('')
+
+    if aliases:
+        table('package aliases',
+              ['alias', 'package'],
+              [(alias, aliases[alias]) for alias in sorted(aliases)])
+
+    if curr_version:
+
+        vals = []
+        for name, var in sorted( package.environ_vars().items() ):
+            if Package.INTERNAL_VARS_RE.match(name):
+                continue
+            var_vals = []
+            for action in var._actions:
+                # Start with the name of the variable if we haven't said it yet
+                if not var_vals:
+                    var_name = name
+                else:
+                    var_name = ''
+
+                # then the action...
+                action_name = type(action).__name__
+
+                # then the value associated with that action - if it's set,
+                # we didn't store the exact value we set it to, so just use
+                # the current value
+                if type(action) == Set:
+                    val = '(?) ' + os.environ.get(name, '<UNSET>')
+                else:
+                    val = action.undo_data
+                var_vals.append( (var_name, action_name, val) )
+            vals.extend(var_vals)
+        table('variables',
+              ['variable', 'action', 'value'],
+              vals, widths=(20,30,11))
+    else:
+        detail('variables', '<inactive>', default_color='red')
+
+def alias(args):
+    # use raw os.environ for speed
+    session = Session(environ=os.environ, pid=args.pid)
+    saved_stdout.write(session.system_alias_script(args.shell))
+
+def env(args):
+    shell = _get_shell(args.shell)
+    var = args.variable[0]
+    value = args.value
+    if args.action == 'prepend':
+        if value is None:
+            logger.error("error: provide a value to prepend")
+            sys.exit(1)
+        prependenv(var, value, no_dupes=True)
+        cmd = shell.setenv(var, os.environ[var])
+    elif args.action == 'pop':
+        popenv(var, value)
+        val = os.environ[var]
+        if val:
+            cmd = shell.setenv(var, os.environ[var])
+        else:
+            cmd = shell.unsetenv(var)
+    elif args.action == 'set':
+        if value is None:
+            logger.error("error: provide a value to set")
+            sys.exit(1)
+        cmd = shell.setenv(var, value)
+    elif args.action == 'unset':
+        cmd = shell.unsetenv(var)
+    else:
+        raise
+    command(cmd)
+
+def set_default(args):
+    shell = _get_shell(args.shell)
+    package = args.package[0]
+    version = args.version
+    var = "SETPKG_%s_DEFAULT_VERSION" % package.upper()
+    if version is None:
+        # print default
+        pass
+        try:
+            error(os.environ[var])
+        except KeyError:
+            error("No default set")
+    elif version == "":
+        cmd = shell.unsetenv(var)
+        command(cmd)
+    else:
+        cmd = shell.setenv(var, version)
+        command(cmd)
+
+def cache(args):
+    if args.clear:
+        resolution_cache.clear()
+        error('cleared %s' % resolution_cache.filename)
+        return
+    stats = resolution_cache.stats()
+    error('resolution cache: %s' % resolution_cache.filename)
+    error('  entries:    %(entries)d / %(size)d' % stats)
+    error('  hits:       %d (%.1f%%)' % (stats['hits'], stats['hit rate'] * 100))
+    error('  misses:     %(misses)d' % stats)
+    error('  stale:      %(stale)d' % stats)
+    error('  evictions:  %(evictions)d' % stats)
+
+def daemon(args):
+    import setpkgd
+    if args.action == 'start':
+        if args.quiet and setpkgd.status() is not None:
+            return
+        pid = setpkgd.start()
+    elif args.action == 'stop':
+        pid = setpkgd.stop()
+    else:
+        pid = setpkgd.status()
+    if pid is None:
+        if args.action == 'start':
+            error('setpkg daemon failed to start')
+        else:
+            error('setpkg daemon is not running')
+    elif args.action == 'stop':
+        error('setpkg daemon stopped (pid %s)' % pid)
+    elif not args.quiet:
+        error('setpkg daemon running (pid %s)' % pid)
+
+
+#===============================================================================
+# Argument parsing
+#===============================================================================
+
+# Each subcommand's parser is built by one of these functions, which are
+# registered in `commands`. to save time, only the parser of the requested
+# subcommand is built (see `_requested_command`).
+
+def _add_set_parser(subparsers):
+    set_parser = subparsers.add_parser('set', help='add packages')
+
+    set_parser.add_argument('package', metavar='PACKAGE', type=str, nargs=1,
+                       help='package to add')
+
+    set_parser.add_argument('-f', '--force', '--reload', dest='reload', action='store_true',
+                       help='set packages even if already set')
+
+    set_parser.add_argument('-n', '--dry-run', dest='dry_run', action='store_true',
+                       help='print the packages which would be added, switched, reloaded '
+                            'and removed, and an estimate of the time it would take, '
+                            'without changing anything')
+
+    set_parser.add_argument('args', metavar='ARGS',  nargs=argparse.REMAINDER,
+                            help='additional arguments for the package. to add several '
+                                 'packages, in order, end them with -- (ie, pkg set a b c --); '
+                                 'arguments after the -- go to the last package')
+
+    if platform_facts.system() == 'Windows':
+        set_parser.add_argument('-g', '--global', dest='set_global', action='store_true',
+                           help='set environment for all sessions until system restart')
+
+    set_parser.set_defaults(func=set_package)
+    set_parser.formatter_class = PkgHelpFormatter
+
+def _add_unset_parser(subparsers):
+    unset_parser = subparsers.add_parser('unset', help='remove packages')
+
+    unset_parser.add_argument('packages', metavar='PACKAGES', type=str, nargs='*',
+                       help='packages to remove')
+
+    unset_parser.add_argument('--all', '-a', dest='all', action='store_true',
+                       help='unset all currently active packages')
+
+    unset_parser.add_argument('--recurse', '-r', action='store_true',
+                       help='recursively unset dependencies of this package')
+
+    if platform_facts.system() == 'Windows':
+        unset_parser.add_argument('-g', '--global', dest='set_global', action='store_true',
+                                  help='unset environment for all sessions until system restart')
+
+    unset_parser.set_defaults(func=unset_packages)
+
+def _add_push_parser(subparsers):
+    push_parser = subparsers.add_parser('push', help='save the active packages, to restore them with pop')
+
+    if platform_facts.system() == 'Windows':
+        push_parser.add_argument('-g', '--global', dest='set_global', action='store_true',
+                                 help='set environment for all sessions until system restart')
+
+    push_parser.set_defaults(func=push_checkpoint)
+
+def _add_pop_parser(subparsers):
+    pop_parser = subparsers.add_parser('pop', help='restore the packages saved by the last push')
+
+    if platform_facts.system() == 'Windows':
+        pop_parser.add_argument('-g', '--global', dest='set_global', action='store_true',
+                                help='set environment for all sessions until system restart')
+
+    pop_parser.set_defaults(func=pop_checkpoint)
+
+def _add_list_parser(subparsers):
+    list_parser = subparsers.add_parser('ls', help='list packages')
+
+    list_parser.add_argument('packages', metavar='PACKAGE', type=str, nargs='?',
+                           help='packages to list')
+
+    list_parser.add_argument('--all', dest='all', action='store_true',
+                       help='list all packages')
+
+    list_parser.add_argument('--base', '-b', dest='base', action='store_true',
+                       help='list only base packages without version')
+
+    list_parser.add_argument('--aliases', dest='aliases', action='store_true',
+                       help='include aliases')
+
+    list_parser.add_argument('--no-regexp', action='store_true',
+                       help='include regexp (if enabled for package)')
+
+    list_parser.add_argument('--prefix', metavar='PREFIX', type=str,
+                       help='with --all, list only packages starting with PREFIX. '
+                            'if PREFIX includes a version (ie, maya-), only that '
+                            'package is read')
+
+    list_parser.set_defaults(func=list_packages)
+
+def _add_run_parser(subparsers):
+    run_parser = subparsers.add_parser('run', help='run a package')
+    run_parser.add_argument('package', metavar='PACKAGE', type=str, nargs=1,
+                             help='package to run')
+    # by setting no prefix_chars, all args are interepreted as positional,
+    # and are caught by runargs, so that if you do:
+    #   pkg run myPackage -myFlag
+    # it will run
+    #   myPackage -myFlag
+    # ...instead of trying to interpret myFlag as a flag for pkg
+    run_parser.prefix_chars=''
+    run_parser.add_argument('runargs', type=str, nargs='*',
+                             help='package to run')
+    run_parser.add_argument('args', metavar='ARGS',  nargs=argparse.REMAINDER,
+                            help='additional arguments')
+    run_parser.set_defaults(func=run_package)
+
+def _add_info_parser(subparsers):
+    info_parser = subparsers.add_parser('info', help='get information about a package')
+    info_parser.add_argument('package', metavar='PACKAGE', type=str, nargs=1,
+                             help='package to query')
+    info_parser.set_defaults(func=info)
+
+def _add_alias_parser(subparsers):
+    alias_parser = subparsers.add_parser('system-alias', help='create system aliases for the current shell')
+    alias_parser.set_defaults(func=alias)
+
+def _add_env_parser(subparsers):
+    env_parser = subparsers.add_parser('env', help='directly modify environment variables')
+
+    env_parser.add_argument('action', metavar='ACTION', type=str, choices=['prepend', 'pop', 'set', 'unset'],
+                             help='%(choices)s')
+    env_parser.add_argument('variable', metavar='VAR', type=str, nargs=1,
+                             help='variable to modify')
+    env_parser.add_argument('value', metavar='VALUE', type=str, nargs='?',
+                             help='value to set')
+    env_parser.set_defaults(func=env)
+
+def _add_default_parser(subparsers):
+    env_parser = subparsers.add_parser('default', help='override package defaults')
+
+    env_parser.add_argument('package', metavar='PACKAGE', type=str, nargs=1,
+                             help='package name')
+    env_parser.add_argument('version', metavar='VERSION', type=str, nargs='?',
+                             help='version to set. omit to print current version')
+    env_parser.set_defaults(func=set_default)
+
+def _add_daemon_parser(subparsers):
+    daemon_parser = subparsers.add_parser('daemon', help='manage the resolver daemon, which keeps setpkg loaded between commands')
+
+    daemon_parser.add_argument('action', metavar='ACTION', type=str, choices=['start', 'stop', 'status'],
+                               help='%(choices)s')
+    daemon_parser.add_argument('--quiet', '-q', action='store_true',
+                               help='only report errors, for use in startup scripts')
+    daemon_parser.set_defaults(func=daemon)
+
+def _add_cache_parser(subparsers):
+    cache_parser = subparsers.add_parser('cache', help='show the hit rate of the resolution cache used by pkg run')
+
+    cache_parser.add_argument('--clear', action='store_true',
+                              help='empty the cache and reset its statistics')
+    cache_parser.set_defaults(func=cache)
+
+# in the order they are listed in the help
+commands = [
+    ('set', _add_set_parser),
+    ('unset', _add_unset_parser),
+    ('push', _add_push_parser),
+    ('pop', _add_pop_parser),
+    ('ls', _add_list_parser),
+    ('run', _add_run_parser),
+    ('info', _add_info_parser),
+    ('system-alias', _add_alias_parser),
+    ('env', _add_env_parser),
+    ('default', _add_default_parser),
+    ('cache', _add_cache_parser),
+    ('daemon', _add_daemon_parser),
+    ]
+
+# options of the main parser which take a value
+_VALUE_OPTIONS = ('--pid', '--shell')
+
+def _requested_command(argv):
+    '''
+    return the name of the subcommand in argv, or None if there isn't one (ie,
+    pkg -h)
+    '''
+    names = set(name for name, builder in commands)
+    i = 0
+    while i < len(argv):
+        arg = argv[i]
+        i += 1
+        if arg in _VALUE_OPTIONS:
+            # like argparse, take the following argument as the option's value
+            # unless it looks like an option
+            if i < len(argv) and not argv[i].startswith('-'):
+                i += 1
+        elif arg in ('-h', '--help'):
+            return None
+        elif not arg.startswith('-'):
+            if arg in names:
+                return arg
+            return None
+    return None
+
+def cli(argv=None):
+    if argv is None:
+        argv = sys.argv[1:]
+    logger.debug(str(sys.argv))
+
+    parser = argparse.ArgumentParser(
+        prog='pkg',
+        usage='%(prog)s [options]',
+        description='Manage environment variables for a software package.')
+
+    parser.add_argument('--pid', metavar='PID', type=str, nargs='?',
+                       help='current process id (usually stored in $$)')
+
+    parser.add_argument('--shell', metavar='SHELL', type=str, nargs='?',
+                       help='the shell from which this is run. (options are %s)' % ', '.join(shells.keys()))
+    parser.add_argument('--no-color', action='store_true', default=False,
+                        help='disable color output')
+
+    subparsers = parser.add_subparsers(help='actions to perform', dest='subparser')
+
+    requested = _requested_command(argv)
+    for name, builder in commands:
+        # when no valid subcommand was given, build them all, for the help and
+        # error messages
+        if requested is None or name == requested:
+            builder(subparsers)
+
+    # monkeypatch with a helper that prints to stderr so we don't eval it
+    def __call__(self, parser, namespace, values, option_string=None):
+        parser.print_help(sys.stderr)
+        parser.exit()
+    parser._registry_get('action', 'help').__call__ = __call__
+    parser.formatter_class = PkgHelpFormatter
+
+    args = parser.parse_args(argv)
+
+    global enable_color
+    enable_color = not args.no_color
+
+    args.func(args)
+
+    logger.info('exiting')
+
+def main(argv=None):
+    global saved_stdout
+    saved_stdout = sys.stdout
+    try:
+        # only result can go to stdout, so pipe all print statements to stderr
+        sys.stdout = sys.stderr
+        cli(argv)
+    finally:
+        sys.stdout = saved_stdout
@@ -0,0 +1,454 @@
+"""
+~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+setpkgd
+~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+An optional, per-user resolver daemon for the ``pkg`` command-line utility.
+
+Normally, every ``pkg`` command starts a new python interpreter, imports setpkg,
+builds the argument parser and reads package headers. The daemon is a long-lived
+process which has already done all of this. ``setpkgcli`` sends it the command
+line, environment and working directory of the command, and the daemon replies
+with the output that the command would have produced. Each command is run in a
+forked child of the daemon, so commands cannot affect one another, but all of
+them start with warm caches.
+
+If the daemon is not running, or cannot handle a command, ``setpkgcli`` runs the
+command itself, as before.
+
+    $ pkg daemon start
+    $ pkg daemon status
+    $ pkg daemon stop
+
+The daemon listens on a unix socket, ``$TMPDIR/setpkg-<uid>/daemon.sock`` by
+default; set ``SETPKG_DAEMON_SOCKET`` to use another path. Set
+``SETPKG_NO_DAEMON`` to always run commands in-process. If setpkg itself is
+updated, the daemon restarts on the next command. If the daemon does not accept
+a command within ``SETPKG_DAEMON_TIMEOUT`` seconds, the command is run
+in-process. Once the daemon has accepted a command, the client waits for it to
+finish, however long it takes, so that packages are never executed twice.
+
+The client half of this module is imported by every ``pkg`` command, so it must
+remain cheap: it only uses modules which are built into the interpreter. setpkg
+is only imported by the server.
+"""
+import os
+import sys
+import marshal
+import struct
+import _socket
+
+PROTOCOL_VERSION = 2
+# marshal format which all supported python versions can read
+MARSHAL_VER = 1
+SOCKET_VAR = 'SETPKG_DAEMON_SOCKET'
+NO_DAEMON_VAR = 'SETPKG_NO_DAEMON'
+TIMEOUT_VAR = 'SETPKG_DAEMON_TIMEOUT'
+# seconds the client waits for the daemon to accept a request
+DEFAULT_TIMEOUT = 10.0
+# seconds the server waits for a client to send its request
+REQUEST_TIMEOUT = 5.0
+# sent by the daemon when it starts to run a command
+ACK = 'ack'
+
+class DaemonError(Exception):
+    '''
+    the daemon accepted a command, but failed to reply
+    '''
+
+def socket_path(environ=None):
+    '''
+    return the path of the daemon's unix socket
+    '''
+    if environ is None:
+        environ = os.environ
+    path = environ.get(SOCKET_VAR)
+    if not path:
+        path = os.path.join(environ.get('TMPDIR', '/tmp'),
+                            'setpkg-%d' % os.getuid(), 'daemon.sock')
+    return path
+
+def reply_timeout(environ=None):
+    '''
+    return the number of seconds to wait for the daemon to accept a request
+    '''
+    if environ is None:
+        environ = os.environ
+    try:
+        return float(environ.get(TIMEOUT_VAR, DEFAULT_TIMEOUT))
+    except ValueError:
+        return DEFAULT_TIMEOUT
+
+def _send(sock, data):
+    sock.sendall(struct.pack('!I', len(data)) + data)
+
+def _recv_exactly(sock, size):
+    chunks = []
+    while size:
+        chunk = sock.recv(min(size, 65536))
+        if not chunk:
+            raise EOFError('connection closed')
+        chunks.append(chunk)
+        size -= len(chunk)
+    return ''.join(chunks)
+
+def _recv(sock):
+    size = struct.unpack('!I', _recv_exactly(sock, 4))[0]
+    return _recv_exactly(sock, size)
+
+def request(command, payload=None, path=None):
+    '''
+    send a request to the daemon and return its reply, or None if the daemon is
+    not running or does not accept the request in time.
+
+    once the daemon has acknowledged a request, its reply is waited for without
+    a timeout, and DaemonError is raised if it cannot be read
+    '''
+    if path is None:
+        path = socket_path()
+    try:
+        # the environment may contain secrets: only talk to our own daemon
+        if os.stat(path).st_uid != os.getuid():
+            return None
+        sock = _socket.socket(_socket.AF_UNIX, _socket.SOCK_STREAM)
+        try:
+            # a timeout raises _socket.timeout, a subclass of _socket.error
+            sock.settimeout(reply_timeout())
+            sock.connect(path)
+            _send(sock, marshal.dumps((PROTOCOL_VERSION, command, payload), MARSHAL_VER))
+            reply = marshal.loads(_recv(sock))
+            if reply != ACK:
+                return reply
+            # the daemon is running the command: it must not be run again
+            sock.settimeout(None)
+            try:
+                return marshal.loads(_recv(sock))
+            except (EnvironmentError, EOFError, ValueError, _socket.error), e:
+                raise DaemonError('no reply from the setpkg daemon: %s' % (e,))
+        finally:
+            sock.close()
+    except (EnvironmentError, EOFError, ValueError, _socket.error):
+        return None
+
+def _wants_daemon(argv):
+    # commands without --shell or --pid need to inspect the calling process,
+    # which is not the daemon's parent. 'pkg daemon' manages the daemon itself.
+    args = set(arg.split('=', 1)[0] for arg in argv)
+    return '--shell' in args and '--pid' in args and 'daemon' not in args
+
+def run_command(argv, setpkg_dir):
+    '''
+    run a setpkgcli command line in the daemon, and write its output to stdout
+    and stderr.
+
+    returns the exit status of the command, or None if the command should be run
+    in-process instead.
+    '''
+    if os.environ.get(NO_DAEMON_VAR) or not _wants_daemon(argv):
+        return None
+    try:
+        reply = request('run', (os.path.abspath(setpkg_dir), list(argv),
+                                dict(os.environ), os.getcwd()))
+    except DaemonError, e:
+        sys.stderr.write('%s\n' % e)
+        return 1
+    if reply is None:
+        return None
+    status, out, err = reply
+    if status is None:
+        return None
+    sys.stdout.write(out)
+    sys.stdout.flush()
+    sys.stderr.write(err)
+    return status
+
+#===============================================================================
+# Server
+#===============================================================================
+
+def _source(module_file):
+    return os.path.splitext(module_file)[0] + '.py'
+
+class Daemon(object):
+    '''
+    Serves setpkgcli commands on a unix socket, running each one in a forked
+    child process.
+    '''
+    def __init__(self, path=None):
+        import setpkg
+        import setpkgcli
+        self.setpkg = setpkg
+        self.cli = setpkgcli
+        self.path = path or socket_path()
+        self.setpkg_dir = os.path.dirname(os.path.realpath(setpkg.__file__))
+        # restart if any of our code changes
+        self.sources = [_source(setpkg.__file__), _source(__file__),
+                        _source(setpkgcli.__file__)]
+        self.fingerprints = [setpkg._stat_fingerprint(f) for f in self.sources]
+        self.restart = False
+        # sys.path, minus the entries added by our own PYTHONPATH, which will
+        # be replaced by those of each client
+        pypath = set(os.environ.get('PYTHONPATH', '').split(os.pathsep))
+        self.base_path = [p for p in sys.path if p not in pypath]
+
+    def warm(self):
+        '''
+        import everything the cli needs and read the headers of all packages on
+        the SETPKG_PATH
+        '''
+        setpkg = self.setpkg
+        # modules which setpkg only imports on the code paths that need them
+        import platform
+        import inspect
+        import subprocess
+        import hashlib
+        import tempfile
+        import ConfigParser
+        session = setpkg.Session(environ=os.environ)
+        try:
+            package_files = list(session.walk_package_files())
+        except ValueError:
+            # SETPKG_PATH not set
+            package_files = []
+        for package_file in package_files:
+            try:
+                pkg = setpkg.Package(package_file, session=session)
+                pkg.versions
+                pkg.aliases
+                pkg.system_aliases
+                # what the completion functions list
+                session._package_file_choices(package_file, aliases=True,
+                                              regexp=True)
+            except Exception, e:
+                setpkg.logger.debug('%s: %s' % (package_file, e))
+        setpkg.PersistentCache.flush_all()
+
+    def bind(self):
+        dirname = os.path.dirname(self.path)
+        if not os.path.isdir(dirname):
+            os.makedirs(dirname, 0700)
+        if os.stat(dirname).st_uid != os.getuid():
+            raise RuntimeError('%s is not owned by the current user' % dirname)
+        if request('ping', path=self.path) is not None:
+            raise RuntimeError('daemon already running on %s' % self.path)
+        if os.path.exists(self.path):
+            # left behind by a daemon which was killed
+            os.remove(self.path)
+        import socket
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.bind(self.path)
+        os.chmod(self.path, 0600)
+        sock.listen(16)
+        return sock
+
+    def can_handle(self, setpkg_dir):
+        if os.path.realpath(setpkg_dir) != self.setpkg_dir:
+            return False
+        if [self.setpkg._stat_fingerprint(f) for f in self.sources] != self.fingerprints:
+            self.restart = True
+            return False
+        return True
+
+    def serve(self):
+        import signal
+        import errno
+        sock = self.bind()
+
+        def terminate(signum, frame):
+            raise SystemExit(0)
+        signal.signal(signal.SIGTERM, terminate)
+        # reap children automatically
+        signal.signal(signal.SIGCHLD, signal.SIG_IGN)
+        try:
+            while not self.restart:
+                try:
+                    conn = sock.accept()[0]
+                except EnvironmentError, e:
+                    if e.errno == errno.EINTR:
+                        continue
+                    raise
+                try:
+                    # don't let a client which never sends its request block
+                    # the others
+                    conn.settimeout(REQUEST_TIMEOUT)
+                    version, command, payload = marshal.loads(_recv(conn))
+                    if version != PROTOCOL_VERSION:
+                        _send(conn, marshal.dumps(None, MARSHAL_VER))
+                    elif command == 'ping':
+                        _send(conn, marshal.dumps(os.getpid(), MARSHAL_VER))
+                    elif command == 'stop':
+                        _send(conn, marshal.dumps(os.getpid(), MARSHAL_VER))
+                        break
+                    elif command == 'run':
+                        if not self.can_handle(payload[0]):
+                            _send(conn, marshal.dumps((None, '', ''), MARSHAL_VER))
+                        else:
+                            self.fork(sock, conn, payload)
+                except Exception, e:
+                    self.setpkg.logger.debug('setpkgd: bad request: %s' % e)
+                conn.close()
+        finally:
+            sock.close()
+            try:
+                os.remove(self.path)
+            except OSError:
+                pass
+        if self.restart:
+            os.execv(sys.executable, [sys.executable, _source(__file__), 'serve', self.path])
+
+    def fork(self, sock, conn, payload):
+        setpkg = self.setpkg
+        # pick up caches written by previous commands, and re-check the
+        # SETPKG_PATH directories, before handing them to the child
+        setpkg.PersistentCache.reload_all()
+        setpkg.package_index.refresh()
+        if os.fork():
+            return
+        status = 1
+        try:
+            try:
+                import signal
+                signal.signal(signal.SIGCHLD, signal.SIG_DFL)
+                signal.signal(signal.SIGTERM, signal.SIG_DFL)
+                sock.close()
+                self.run(conn, payload)
+                status = 0
+            except:
+                import traceback
+                traceback.print_exc(file=sys.__stderr__)
+        finally:
+            os._exit(status)
+
+    def run(self, conn, payload):
+        '''
+        run a command in the current (forked) process, as if setpkgcli was
+        called by the client, and send back the output
+        '''
+        setpkg_dir, argv, environ, cwd = payload
+        # from here on, the client waits for the command to finish
+        _send(conn, marshal.dumps(ACK, MARSHAL_VER))
+        os.environ.clear()
+        os.environ.update(environ)
+        try:
+            os.chdir(cwd)
+        except OSError:
+            pass
+        sys.argv = argv
+        pypath = [p for p in environ.get('PYTHONPATH', '').split(os.pathsep) if p]
+        sys.path[:] = [self.setpkg_dir] + pypath + self.base_path
+        self.setpkg._set_log_level()
+
+        out = os.tmpfile()
+        err = os.tmpfile()
+        # if the daemon was started by setpkgcli, sys.stdout may still be
+        # redirected to stderr
+        sys.stdout = sys.__stdout__
+        sys.stderr = sys.__stderr__
+        sys.stdout.flush()
+        sys.stderr.flush()
+        os.dup2(out.fileno(), 1)
+        os.dup2(err.fileno(), 2)
+        status = 0
+        try:
+            self.cli.main(argv[1:])
+        except SystemExit, e:
+            if e.code is None:
+                status = 0
+            elif isinstance(e.code, int):
+                status = e.code
+            else:
+                sys.stderr.write('%s\n' % (e.code,))
+                status = 1
+        except:
+            import traceback
+            traceback.print_exc()
+            status = 1
+        sys.stdout.flush()
+        sys.stderr.flush()
+        self.setpkg.PersistentCache.flush_all()
+
+        out.seek(0)
+        err.seek(0)
+        _send(conn, marshal.dumps((status, out.read(), err.read()), MARSHAL_VER))
+
+def _daemonize():
+    '''
+    detach from the calling process. returns True in the daemon, and False in
+    the caller
+    '''
+    pid = os.fork()
+    if pid:
+        os.waitpid(pid, 0)
+        return False
+    os.setsid()
+    if os.fork():
+        os._exit(0)
+    # setpkgcli's output is eval'ed by the shell, which waits for it to be
+    # closed: don't hold on to it
+    devnull = os.open(os.devnull, os.O_RDWR)
+    for fd in (0, 1, 2):
+        os.dup2(devnull, fd)
+    os.close(devnull)
+    return True
+
+def status(path=None):
+    '''
+    return the pid of the running daemon, or None
+    '''
+    return request('ping', path=path)
+
+def start(path=None, timeout=10.0):
+    '''
+    start the daemon in the background, if it is not already running, and
+    return its pid
+    '''
+    import time
+    pid = status(path)
+    if pid is not None:
+        return pid
+    if _daemonize():
+        code = 0
+        try:
+            try:
+                daemon = Daemon(path)
+                daemon.warm()
+                daemon.serve()
+            except:
+                code = 1
+        finally:
+            os._exit(code)
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        pid = status(path)
+        if pid is not None:
+            return pid
+        time.sleep(0.05)
+    return None
+
+def stop(path=None):
+    '''
+    stop the daemon. returns the pid of the stopped daemon, or None if it was
+    not running
+    '''
+    return request('stop', path=path)
+
+def main(argv):
+    usage = 'usage: setpkgd.py start|stop|status|serve [SOCKET]'
+    if not argv or argv[0] not in ('start', 'stop', 'status', 'serve'):
+        sys.stderr.write(usage + '\n')
+        return 2
+    path = argv[1] if len(argv) > 1 else None
+    if argv[0] == 'serve':
+        daemon = Daemon(path)
+        daemon.warm()
+        daemon.serve()
+        return 0
+    pid = {'start' : start, 'stop' : stop, 'status' : status}[argv[0]](path)
+    if pid is None:
+        sys.stderr.write('setpkg daemon is not running\n')
+        return 1
+    sys.stderr.write('setpkg daemon: pid %s\n' % pid)
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -53,8 +53,32 @@ function delevn {
 }
 export -f delevn
 
-# system aliases
-pkg system-alias
+# keep setpkg loaded in a per-user daemon, if requested
+[[ $SETPKG_DAEMON ]] && pkg daemon start --quiet
+
+# system aliases: source the script generated for this SETPKG_PATH, then
+# regenerate it in the background in case a package has changed since
+_setpkg_aliases=${SETPKG_CACHE_DIR:-${XDG_CACHE_HOME:-$HOME/.cache}/setpkg}/aliases/bash-$(printf %s "$SETPKG_PATH" | cksum | tr -s ' ' -)
+if [[ -z $SETPKG_NO_CACHE && -f $_setpkg_aliases ]]; then
+    source "$_setpkg_aliases"
+    ( $SETPKG_PYTHONBIN $SETPKG_ROOT/bin/setpkgcli --shell bash --pid $$ system-alias >/dev/null 2>&1 & )
+else
+    pkg system-alias
+fi
+unset _setpkg_aliases
+
+# set takes one package, followed by its arguments, or several packages ended by
+# --. succeeds if the word being completed is a package: the word at the given
+# index (the first package), or a word before a -- further on
+_setpkg_packages_at()
+{
+    local i
+    [[ ${COMP_CWORD} -eq $1 ]] && return 0
+    for (( i=COMP_CWORD+1; i<${#COMP_WORDS[@]}; i++ )); do
+        [[ ${COMP_WORDS[i]} == -- ]] && return 0
+    done
+    return 1
+}
 
 _pkg() 
 {
@@ -64,9 +88,13 @@ _pkg()
     prev="${COMP_WORDS[COMP_CWORD-1]}"
     opts="set unset info ls"
 
+    # set and unset take several packages
+    [[ ${COMP_CWORD} -gt 1 ]] && prev="${COMP_WORDS[1]}"
+
     case "${prev}" in
         set)
-        local packages=`pkg ls --all --aliases`
+        _setpkg_packages_at 2 || return 0
+        local packages=`pkg ls --all --aliases --prefix="${cur}"`
         COMPREPLY=( $(compgen -W "${packages}" -- ${cur}) )
             return 0
             ;;
@@ -91,7 +119,8 @@ _setpkg()
     cur="${COMP_WORDS[COMP_CWORD]}"
     COMPREPLY=()
 
-    packages=`pkg ls --all --aliases`
+    _setpkg_packages_at 1 || return 0
+    packages=`pkg ls --all --aliases --prefix="${cur}"`
     COMPREPLY=( $(compgen -W "${packages}" -- ${cur}) )
 
     return 0